@@ -32,11 +32,14 @@ local cgc_csid = ProtoField.uint32("cgc.csid", "Challenge Set")
 local cgc_connection_id = ProtoField.uint32("cgc.connection_id", "Connection ID")
 local cgc_message_id = ProtoField.uint32("cgc.message_id", "Message ID")
 local cgc_message_len = ProtoField.uint16("cgc.message_len", "Message Length")
-local cgc_side = ProtoField.uint8("cgc.side", "Side", base.DEC, CGC_SIDES)
+-- version 1 messages use the whole byte for the side, version 2 and later
+-- record the version in the high bits
+local cgc_version = ProtoField.uint8("cgc.version", "Version", base.DEC, nil, 0xF0)
+local cgc_side = ProtoField.uint8("cgc.side", "Side", base.DEC, CGC_SIDES, 0x0F)
 local cgc_message = ProtoField.bytes("cgc.message", "Message")
 
 cgc_proto.experts = { cgc_error_len }
-cgc_proto.fields = { cgc_csid, cgc_connection_id, cgc_message_id, cgc_message_len, cgc_side, cgc_message}
+cgc_proto.fields = { cgc_csid, cgc_connection_id, cgc_message_id, cgc_message_len, cgc_version, cgc_side, cgc_message}
 
 function cgc_proto.dissector(buffer, pinfo, root)
     pinfo.cols.protocol:set("CGC")
@@ -44,7 +47,7 @@ function cgc_proto.dissector(buffer, pinfo, root)
     local pktlen = buffer:reported_length_remaining()
 
     if pktlen < 15 then
-        tree:add_proto_expert_info(cgc_error_len)
+        root:add_proto_expert_info(cgc_error_len)
         return
     end
 
@@ -55,6 +58,7 @@ function cgc_proto.dissector(buffer, pinfo, root)
     tree:add_le(cgc_message_id, buffer:range(8, 4))
     local message_len = buffer:range(12, 2)
     tree:add_le(cgc_message_len, message_len)
+    tree:add_le(cgc_version, buffer:range(14, 1))
     tree:add_le(cgc_side, buffer:range(14, 1))
     tree:add_le(cgc_message, buffer(15, message_len:le_uint()))
 end
@@ -28,9 +28,10 @@ import sys
 import re2 as re
 import string
 import logging
-import copy
 from . import ids_parser
 from . import base
+from . import packet_log
+from . import prefilter
 from . import rule_options
 
 
@@ -41,18 +42,44 @@ class Filter(base.FilterBaseClass):
     iterates through the rule options, executing the appropriate rule option
     validation callback function.
 
+    The rule can also be compiled into a single generated function, with
+    the source of each rule option inlined in order, which is used instead
+    of iterating through the rule options.
+
 
     Attributes:
         name: name of the rule
         rule_type: Type of rule (should be admit, alert, or block)
         options: A list of rule options
         flush: The side of the session that should be flushed, if any
+        sides: The sides of the session the rule can match, based on the
+            'side' rule options
+        offset_dependent: True if the rule uses rule options that can match
+            at a later offset after failing at an earlier offset ('regex' and
+            'match' with a depth)
+        literals: literal ids (from NetworkFilter's LiteralSet) of every
+            'match' rule option, all of which must be in the buffer for the
+            rule to match
+        regex_index: dict of side to the index into NetworkFilter's RegexSet
+            for that side of the 'regex' rule option, if it is the first rule
+            option that inspects content
+        state_mask: bitmask of the state bits checked by 'state' rule options
+        check: function used to evaluate the rule, either 'evaluate' or the
+            function generated by 'compile'
+        source: source of the function generated by 'compile', if any
     """
     def __init__(self, data):
         self.name = None
         self.options = []
         self.rule_type = None
         self.flush = None
+        self.sides = (self.CLIENT, self.SERVER)
+        self.offset_dependent = False
+        self.literals = ()
+        self.regex_index = {self.CLIENT: None, self.SERVER: None}
+        self.state_mask = 0
+        self.check = self.evaluate
+        self.source = None
         self.load(data)
 
     def __repr__(self):
@@ -117,38 +144,253 @@ class Filter(base.FilterBaseClass):
             assert option[0] in methods, 'unknown option %s' % repr(option[0])
             self.options.append(methods[option[0]](option[1]))
 
+        for option in self.options:
+            if isinstance(option, rule_options.FilterSide):
+                self.sides = tuple(x for x in self.sides if x == option.side)
+            if isinstance(option, rule_options.FilterRegex):
+                self.offset_dependent = True
+            if (isinstance(option, rule_options.FilterMatch) and
+                    option.depth is not None):
+                self.offset_dependent = True
+
         if self.rule_type == 'block':
             self.options.append(rule_options.FilterBlock())
 
-    def evaluate(self, state, side, data):
+    def evaluate(self, side, data):
         """
         Evaluate a rule
 
         Arguments:
-            state: A dict representing per-session states saved by 'state' rule
-                options
             side: The side of the session the data is from.  needed by 'side'
                 rule options
-            data: FilterData instance representing data being analyzed
+            data: FilterData instance representing data being analyzed,
+                including the per-session state bitmask used by 'state' rule
+                options
 
         Returns:
             None on rule match failure
             The evaluated 'data' on rule match success (could be modified by
-                the rules, both offset and content)
+                the rules, offset, content, and state)
 
         Raises:
             None
         """
         for option in self.options:
-            logging.debug('testing %s : %s : %s', repr(state), repr(side),
-                          repr(option))
-            data = option.cb_check(state, side, data)
-            logging.debug('result: %s', repr(data))
+            logging.debug('testing %r : %r : %r', data.state, side, option)
+            data = option.cb_check(side, data)
+            logging.debug('result: %r', data)
             if data is None:
                 return None
 
         return data
 
+    def compile(self, debug=False):
+        """
+        Compile the rule into a single function, with the same arguments and
+        results as 'evaluate', and use it as 'check'.
+
+        Constants used by the rule options are inlined into the source, or
+        bound as default arguments, such that they are locals.  The same
+        tracing performed by 'evaluate' is only included if 'debug' is set.
+
+        Arguments:
+            debug: include tracing of each rule option
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        bindings = {}
+        body = []
+        for index, option in enumerate(self.options):
+            name = 'option_%d' % index
+            source = option.cb_source(name, bindings)
+            if debug:
+                bindings['log'] = logging.debug
+                bindings['trace_%d' % index] = option
+                body.append("log('testing %%r : %%r : %%r', data.state, side, "
+                            "trace_%d)" % index)
+                traced = []
+                for line in source:
+                    if line.strip() == 'return None':
+                        indent = line[:len(line) - len(line.lstrip())]
+                        traced.append("%slog('result: %%r', None)" % indent)
+                    traced.append(line)
+                source = traced + ["log('result: %r', data)"]
+            body += source
+
+        arguments = ''.join(', %s=%s' % (name, name)
+                            for name in sorted(bindings))
+        lines = ['def check(side, data%s):' % arguments]
+        lines += ['    ' + line for line in body]
+        lines.append('    return data')
+        self.source = '\n'.join(lines) + '\n'
+
+        namespace = dict(bindings)
+        exec compile(self.source, '<rule %s>' % self.name, 'exec') in namespace
+        self.check = namespace['check']
+
+
+class Session(object):
+    """
+    The per-session inspection state of a NetworkFilter
+
+    Attributes:
+        windows: list of the InspectionWindow of each side, indexed by side
+        literals: list of dicts of literal id to the offset into the stream
+            of the last occurrence of the literal, indexed by side
+        state: session state bitmask
+        positions: list of the offset into the stream of data from each side
+            of the start of its inspection buffer, indexed by side
+        watermarks: list of dicts of rule index to (stream offset, state
+            bits read by the rule), indexed by side.  The rule can not match
+            at that stream offset with those state bits, no matter what data
+            is added to the inspection buffer.
+        searched: list of dicts of the 'match' searches that did not find
+            their string, for FilterData.search, indexed by side.  Cleared
+            when the content of the inspection buffer is modified.
+    """
+    __slots__ = ('windows', 'literals', 'state', 'positions', 'watermarks',
+                 'searched')
+
+    def __init__(self, buffer_size=None):
+        self.windows = [base.InspectionWindow(buffer_size),
+                        base.InspectionWindow(buffer_size)]
+        self.literals = [{}, {}]
+        self.state = 0
+        self.positions = [0, 0]
+        self.watermarks = [{}, {}]
+        self.searched = [{}, {}]
+
+    def __repr__(self):
+        return '<Session client:%s server:%s state:%d>' % (
+            repr(self.windows[base.FilterBaseClass.CLIENT]),
+            repr(self.windows[base.FilterBaseClass.SERVER]), self.state)
+
+
+class SessionManager(object):
+    """
+    Tracks the sessions of a NetworkFilter, from open to close
+
+    Attributes:
+        sessions: dict of session identifier to Session
+        buffer_size: maximum size of the inspection buffer of a session side
+        opened: number of sessions opened
+        closed: number of sessions closed
+    """
+    def __init__(self, buffer_size=None):
+        self.sessions = {}
+        self.buffer_size = buffer_size
+        self.opened = 0
+        self.closed = 0
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __contains__(self, session):
+        return session in self.sessions
+
+    def __getitem__(self, session):
+        return self.sessions[session]
+
+    def __iter__(self):
+        return iter(self.sessions)
+
+    def __repr__(self):
+        return repr(self.sessions)
+
+    def get(self, session):
+        """
+        Get the Session for a session identifier
+
+        Arguments:
+            session: session identifier
+
+        Returns:
+            The Session, or None if the session is not open
+
+        Raises:
+            None
+        """
+        return self.sessions.get(session)
+
+    def open(self, session):
+        """
+        Start tracking a session
+
+        Arguments:
+            session: session identifier
+
+        Returns:
+            The Session for the session identifier
+
+        Raises:
+            AssertionError if the session is already open
+        """
+        assert session not in self.sessions
+        record = Session(self.buffer_size)
+        self.sessions[session] = record
+        self.opened += 1
+        return record
+
+    def close(self, session):
+        """
+        Stop tracking a session, releasing its inspection buffers
+
+        Arguments:
+            session: session identifier
+
+        Returns:
+            True if the session was open, False otherwise
+
+        Raises:
+            None
+        """
+        if self.sessions.pop(session, None) is None:
+            return False
+        self.closed += 1
+        return True
+
+    def bytes_retained(self):
+        """
+        Count the bytes of data retained in the inspection buffers of every
+        open session
+
+        Arguments:
+            None
+
+        Returns:
+            The number of bytes retained
+
+        Raises:
+            None
+        """
+        # a snapshot of the sessions, as the evaluation threads of cb-proxy
+        # open and close sessions while this is summed
+        return sum(len(window) for record in self.sessions.values()
+                   for window in record.windows)
+
+    def bytes_allocated(self):
+        """
+        Count the bytes allocated for the inspection buffers of every open
+        session
+
+        Arguments:
+            None
+
+        Returns:
+            The number of bytes allocated
+
+        Raises:
+            None
+        """
+        # a snapshot of the sessions, as the evaluation threads of cb-proxy
+        # open and close sessions while this is summed
+        return sum(len(window.data) for record in self.sessions.values()
+                   for window in record.windows)
+
 
 class NetworkFilter(base.FilterBaseClass):
     """ NetworkFilter - A simplified network filter
@@ -166,17 +408,47 @@ class NetworkFilter(base.FilterBaseClass):
 
     Attributes:
         filters: List of Filters
+        side_filters: dict of side to the list of Filters that can match
+            data from that side, in rule order
         offset:  Offset into the buffer for the current rule
-        state:   Dict of states
+        state:   Dict of state names to their bit in the session state
+            bitmask
+        sessions: SessionManager of the open sessions
+        literal_set: LiteralSet of every 'match' rule option string, or None
+            if no rules use 'match'
+        regex_set: dict of side to the RegexSet of the 'regex' rule options
+            that start rules for that side, for sides with at least two
+        offset_dependent: dict of side to the indexes into side_filters of
+            the rules that can start matching when the offset moves forward
+        state_readers: dict of side to a dict of state bit to the indexes
+            into side_filters of the rules that check the state bit
+        finishable: dict of side to True if a session can reach a point
+            where no rule for that side can match again, see finished()
+        reference: evaluate every rule after each match, rather than only
+            the rules a match could affect, using the rule option
+            interpreter rather than compiled rules
+        prefilter: skip evaluating rules whose 'match' strings are not in
+            the inspection buffer, or whose leading 'regex' does not match
+        debug: log the evaluation of each rule option, and the inspection
+            buffers after each evaluation
     """
 
-    def __init__(self, rules, buffer_size=None):
+    def __init__(self, rules, buffer_size=None, reference=False,
+                 prefilter=True):
         self.filters = []
+        self.side_filters = {self.CLIENT: [], self.SERVER: []}
         self.state = {}
-        self.sessions = {}
+        self.sessions = SessionManager(buffer_size)
+        self.literal_set = None
+        self.regex_set = {}
+        self.offset_dependent = {self.CLIENT: [], self.SERVER: []}
+        self.state_readers = {self.CLIENT: {}, self.SERVER: {}}
+        self.finishable = {self.CLIENT: False, self.SERVER: False}
         parser = ids_parser.ids_parser()
         self.buffer_size = buffer_size
-        self.debug = False
+        self.reference = reference
+        self.prefilter = prefilter
+        self._debug = False
 
         lines = None
         if isinstance(rules, file):
@@ -197,20 +469,362 @@ class NetworkFilter(base.FilterBaseClass):
                 self.filters.append(Filter(rule))
         logging.debug('loaded %s', repr(self.filters))
 
+        for _filter in self.filters:
+            for side in _filter.sides:
+                self.side_filters[side].append(_filter)
+
+        self._intern_states()
+        if not self.reference:
+            if self.prefilter:
+                self._build_literal_set()
+                self._build_regex_set()
+            self._build_dependencies()
+            self._build_finishable()
+            self._compile()
+
+    @property
+    def debug(self):
+        """ True if debug logging is enabled """
+        return self._debug
+
+    @debug.setter
+    def debug(self, value):
+        self._debug = value
+        if not self.reference:
+            self._compile()
+
+    def _compile(self):
+        """
+        Compile every rule, including tracing if debug logging is enabled.
+
+        Arguments:
+            None
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        for _filter in self.filters:
+            _filter.compile(self._debug)
+
+    def _build_literal_set(self):
+        """
+        Build a LiteralSet from the 'match' rule options of every rule, such
+        that a single pass over new data identifies which rules could match.
+
+        Arguments:
+            None
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        literal_set = prefilter.LiteralSet()
+        literals = {}
+        for _filter in self.filters:
+            for option in _filter.options:
+                if isinstance(option, rule_options.FilterMatch):
+                    literals.setdefault(_filter, set()).add(
+                        literal_set.add(option.string))
+
+        # the set only searches new data, while a rule searches its whole
+        # inspection buffer from its offset, so even a single rule that
+        # could not match skips that search
+        if not len(literals):
+            return
+
+        self.literal_set = literal_set
+        for _filter, literal_ids in literals.iteritems():
+            _filter.literals = tuple(literal_ids)
+
+    def _build_regex_set(self):
+        """
+        Build a RegexSet per side from the 'regex' rule options that are the
+        first rule option to inspect content in each rule.  These are all
+        matched against the same offset, so a single scan identifies which of
+        them can match.
+
+        Arguments:
+            None
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        for side in self.side_filters:
+            regex_set = prefilter.RegexSet()
+            indexes = {}
+            for _filter in self.side_filters[side]:
+                for option in _filter.options:
+                    if isinstance(option, (rule_options.FilterSide,
+                                           rule_options.FilterState)):
+                        continue
+                    if (isinstance(option, rule_options.FilterRegex) and
+                            option.positional):
+                        index = regex_set.add(option.pattern)
+                        if index is not None:
+                            indexes[_filter] = index
+                    break
+
+            # a set of a single regex only repeats the work of the rule
+            if len(regex_set) < 2:
+                continue
+
+            regex_set.compile()
+            self.regex_set[side] = regex_set
+            for _filter, index in indexes.iteritems():
+                _filter.regex_index[side] = index
+
+    def _intern_states(self):
+        """
+        Assign each state name used by 'state' rule options a bit in the
+        per-session state bitmask.
+
+        Arguments:
+            None
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        for _filter in self.filters:
+            for option in _filter.options:
+                if isinstance(option, rule_options.FilterState):
+                    if option.name not in self.state:
+                        self.state[option.name] = 1 << len(self.state)
+                    option.mask = self.state[option.name]
+                    if option.keyword in ['is', 'not']:
+                        _filter.state_mask |= option.mask
+
+    def _build_dependencies(self):
+        """
+        Index which rules need to be evaluated again when the offset moves
+        forward, or a state bit changes.
+
+        Arguments:
+            None
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        for side, filters in self.side_filters.items():
+            for index, _filter in enumerate(filters):
+                if _filter.offset_dependent:
+                    self.offset_dependent[side].append(index)
+
+                for option in _filter.options:
+                    if not isinstance(option, rule_options.FilterState):
+                        continue
+                    if option.keyword not in ['is', 'not']:
+                        continue
+                    readers = self.state_readers[side].setdefault(option.mask,
+                                                                  [])
+                    if index not in readers:
+                        readers.append(index)
+
+    def _build_finishable(self):
+        """
+        Determine for each side if a session can reach a point where no rule
+        for that side can match again.  A rule that can not match at the
+        current offset, with the current state bits, can only match once the
+        offset or the state bits change.  Without a match for that side,
+        that only happens if a rule for the other side changes a state bit
+        the rules check, or flushes the side, or if truncating the
+        inspection buffer moves the offset of rules with 'regex' or 'match'
+        depth rule options.
+
+        Arguments:
+            None
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        for side, filters in self.side_filters.items():
+            other = self.SERVER if side == self.CLIENT else self.CLIENT
+            state_mask = 0
+            finishable = True
+            for _filter in filters:
+                state_mask |= _filter.state_mask
+                if self.buffer_size is not None and _filter.offset_dependent:
+                    finishable = False
+
+            for _filter in self.side_filters[other]:
+                if _filter.flush == side:
+                    finishable = False
+                for option in _filter.options:
+                    if (isinstance(option, rule_options.FilterState) and
+                            option.keyword in ['set', 'unset'] and
+                            option.mask & state_mask):
+                        finishable = False
+            self.finishable[side] = finishable
+
+    def _scan_literals(self, session, side, combined, start):
+        """
+        Update the per-session record of where each literal was last seen in
+        the stream, scanning only the data added to the inspection buffer.
+
+        Offsets into the stream are not changed by removing data from the
+        inspection buffer.  Literals that are no longer in the buffer are
+        before any offset a rule is evaluated from, as are literals in data
+        that was blocked, such that both are ignored without being removed.
+
+        Arguments:
+            session: Session being analyzed
+            side: side of the traffic being analyzed
+            combined: FilterData of the inspection buffer
+            start: offset into the buffer of the data added to it
+
+        Returns:
+            dict of literal id to the stream offset of the last occurrence
+
+        Raises:
+            None
+        """
+        return self.literal_set.scan(combined.data, combined.start + start,
+                                     session.literals[side], combined.start,
+                                     combined.end, session.positions[side])
+
+    @staticmethod
+    def _has_literals(_filter, hits, offset):
+        """
+        Check if every literal required by a rule has been seen at or after
+        the specified offset.
+
+        Arguments:
+            _filter: the Filter being checked
+            hits: dict of literal id to the stream offset of the last
+                occurrence
+            offset: offset into the stream the rule is evaluated from
+
+        Returns:
+            False if the rule can not match, True otherwise
+
+        Raises:
+            None
+        """
+        for literal_id in _filter.literals:
+            if hits.get(literal_id, -1) < offset:
+                return False
+        return True
+
     def __delitem__(self, session):
-        if session in self.sessions:
-            del self.sessions[session]
+        self.close(session)
 
     def __repr__(self):
         return '<NetworkFilter %s>' % (repr(self.sessions))
 
+    def open(self, session):
+        """
+        Start inspecting a session.  Sessions are opened when they are first
+        evaluated if they have not been opened already.
+
+        Arguments:
+            session: session identifier
+
+        Returns:
+            The Session for the session identifier
+
+        Raises:
+            AssertionError if the session is already open
+        """
+        return self.sessions.open(session)
+
+    def close(self, session):
+        """
+        Stop inspecting a session, releasing its inspection buffers
+
+        Arguments:
+            session: session identifier
+
+        Returns:
+            True if the session was open, False otherwise
+
+        Raises:
+            None
+        """
+        return self.sessions.close(session)
+
+    def finished(self, session, side):
+        """
+        Check if no rule for a side can match the traffic of a session again,
+        such that the rest of the traffic from that side does not need to be
+        inspected.  Once a side is finished, it stays finished.
+
+        Rules without a watermark at the current offset, such as those
+        skipped by the prefilters, are evaluated to find if they can match
+        once more data is added.  Rules that can not are given a watermark.
+
+        Arguments:
+            session: session identifier
+            side: side of the traffic
+
+        Returns:
+            True if no rule for the side can match again, False otherwise
+
+        Raises:
+            None
+        """
+        if not self.finishable[side]:
+            return False
+        record = self.sessions.get(session)
+        if record is None:
+            return False
+
+        window = record.windows[side]
+        watermarks = record.watermarks[side]
+        combined = None
+
+        # the offset every rule is evaluated from next
+        stream_offset = record.positions[side]
+        for index, _filter in enumerate(self.side_filters[side]):
+            state = record.state & _filter.state_mask
+            mark = watermarks.get(index)
+            if (mark is not None and mark[1] == state and
+                    (mark[0] == stream_offset or
+                     (mark[0] < stream_offset and
+                      not _filter.offset_dependent))):
+                continue
+
+            if combined is None:
+                combined = base.FilterData(window.data, record.state,
+                                           window.start, window.end)
+            combined.offset = window.start
+            combined.state = record.state
+            combined.open_ended = False
+            try:
+                ret = _filter.check(side, combined)
+            except base.NetworkFilterException:
+                ret = combined
+            combined.rollback(0)
+            if ret is not None or combined.open_ended:
+                return False
+            watermarks[index] = (stream_offset, state)
+        return True
+
     def __call__(self, session, side, data):
         """
         Evaluate a set of filters
 
         Arguments:
+            session: session identifier
             side: side of the traffic being analyized.
-            data: input string being analyzed
+            data: input string being analyzed.  A bytearray or memoryview is
+                copied into the inspection buffer, so the caller may reuse
+                it once the call returns.
 
         Returns:
             data:  Returns the data that should be sent on.  (May be modified
@@ -218,27 +832,266 @@ class NetworkFilter(base.FilterBaseClass):
 
         Raises:
             AssertionError if side is invalid
-            AssertionError data is not a string
+            AssertionError data is not a string, bytearray or memoryview
             NetworkFilterBlock if the traffic should be blocked
         """
         assert side in (self.CLIENT, self.SERVER)
-        assert isinstance(data, str)
+        assert isinstance(data, (str, bytearray, memoryview))
 
-        if session not in self.sessions:
-            self.sessions[session] = {self.CLIENT: '', self.SERVER: '',
-                                      'state': {}}
+        record = self.sessions.get(session)
+        if record is None:
+            record = self.open(session)
 
-        offset = 0
-       
+        window = record.windows[side]
         if self.buffer_size is not None:
             data_len = len(data)
-            buff_len = len(self.sessions[session][side])
+            buff_len = len(window)
             if data_len + buff_len > self.buffer_size:
                 logging.info("truncating inspection buffer by %d bytes" % data_len)
-                self.sessions[session][side] = self.sessions[session][side][data_len:]
+                record.positions[side] += min(data_len, buff_len)
+                window.trim(data_len)
+
+        orig_len = len(window)
+        window.append(data)
+        orig_end = window.end - len(data)
+        combined = base.FilterData(window.data, record.state, window.start,
+                                   window.end)
+        if not self.reference:
+            combined.searched = record.searched[side]
+            combined.position = record.positions[side] - window.start
+
+        try:
+            if self.reference:
+                combined, matched, should_flush = self._evaluate_reference(
+                    record, side, combined)
+            else:
+                combined, matched, should_flush = self._evaluate(
+                    record, side, combined, orig_len)
+        except base.NetworkFilterException:
+            # the retained buffer does not include blocked data
+            combined.rollback(0)
+            window.truncate(orig_end)
+            record.watermarks[side].clear()
+            record.searched[side].clear()
+            raise
+
+        consumed = combined.offset - combined.start
+        window.trim(consumed)
+        record.positions[side] += consumed
+
+        for flush in should_flush:
+            record.positions[flush] += len(record.windows[flush])
+            record.windows[flush].clear()
+            record.literals[flush] = {}
+            record.watermarks[flush].clear()
+            record.searched[flush].clear()
+
+        if self.debug:
+            logging.debug('session %r', record)
+
+        return combined.data_after(orig_end), matched
+
+    @staticmethod
+    def _check(_filter, side, combined):
+        """
+        Evaluate a single rule against the inspection buffer, restoring the
+        offset and state of the buffer if the rule does not match.
+
+        Arguments:
+            _filter: the Filter to evaluate
+            side: side of the traffic being analyzed
+            combined: FilterData of the inspection buffer
+
+        Returns:
+            None if the rule did not match, otherwise the FilterData returned
+                by the rule
+
+        Raises:
+            NetworkFilterException if a 'block' rule matched
+        """
+        offset = combined.offset
+        state = combined.state
+        patches = len(combined.patches)
+        try:
+            ret = _filter.check(side, combined)
+        except base.NetworkFilterException:
+            # report the unmodified content, up to the first replacement
+            if len(combined.patches) > patches:
+                combined.offset = combined.patches[patches][0]
+                combined.rollback(patches)
+            raise base.NetworkFilterException('filter matched %s: %s' %
+                                              (repr(_filter.name),
+                                               repr(combined.seen())))
+        if ret is None:
+            logging.debug('filter did not match %r: %r', _filter.name,
+                          combined)
+            combined.offset = offset
+            combined.state = state
+            combined.rollback(patches)
+        return ret
+
+    def _evaluate(self, session, side, combined, orig_len):
+        """
+        Evaluate the rules for a side against the inspection buffer.
+
+        Each pass looks for the first rule, in rule order, that matches at the
+        current offset.  Rather than starting every pass from the first rule,
+        rules that did not match are only evaluated again if the previous
+        match could have changed their result.  Rules without 'regex' or
+        'match' depth rule options can not start matching because the offset
+        moved forward, so they are only evaluated again if the match changed
+        the content of the buffer, or a state bit they check.
+
+        Arguments:
+            session: Session being analyzed
+            side: side of the traffic being analyzed
+            combined: FilterData of the inspection buffer
+            orig_len: length of the buffer before the new data was added
+
+        Returns:
+            A tuple of the evaluated FilterData, a list of the names of the
+                rules that matched, and a list of the sides to be flushed
+
+        Raises:
+            NetworkFilterException if a 'block' rule matched
+        """
+        filters = self.side_filters[side]
+        matched = []
+        should_flush = []
+
+        # find every literal in the new data once, rather than per rule.
+        # literal offsets are relative to the start of the stream.
+        hits = {}
+        if self.literal_set is not None:
+            hits = self._scan_literals(session, side, combined, orig_len)
+
+        # rules that can not match at an offset into the stream, no matter
+        # what data is added, are not evaluated at that offset again
+        watermarks = session.watermarks[side]
+        stream_start = session.positions[side] - combined.start
+
+        # indexes of the rules that might match at the current offset
+        pending = range(len(filters))
+
+        while len(pending):
+            current_offset = combined.offset
+            state = combined.state
+            patches = len(combined.patches)
+            regex_matches = None
+            ret = None
+
+            stream_offset = stream_start + combined.offset
+            for position, index in enumerate(pending):
+                _filter = filters[index]
+                mark = watermarks.get(index)
+                if (mark is not None and
+                        mark[1] == combined.state & _filter.state_mask and
+                        (mark[0] == stream_offset or
+                         (mark[0] < stream_offset and
+                          not _filter.offset_dependent))):
+                    continue
+
+                if (_filter.literals and
+                        not self._has_literals(_filter, hits, stream_offset)):
+                    continue
 
-        combined = base.FilterData(self.sessions[session][side] + data)
+                # match every leading regex at this offset in one scan
+                regex_index = _filter.regex_index[side]
+                if regex_index is not None:
+                    if regex_matches is None:
+                        regex_set = self.regex_set[side]
+                        regex_matches = regex_set.match(combined.data,
+                                                        combined.offset,
+                                                        combined.end)
+                    found, count = regex_matches
+                    if regex_index < count and regex_index not in found:
+                        continue
 
+                combined.open_ended = False
+                ret = self._check(_filter, side, combined)
+                if ret is not None:
+                    break
+                if not combined.open_ended:
+                    watermarks[index] = (stream_offset,
+                                         combined.state & _filter.state_mask)
+
+            if ret is None:
+                break
+
+            # 'admit' rules parse traffic, but don't generate logs
+            if _filter.rule_type != 'admit':
+                matched.append(_filter.name)
+
+            # replacements are made at the offset of a match, which is then
+            # moved past the replaced content, so the literals found at or
+            # after the new offset are unchanged
+            modified = len(combined.patches) > patches
+            if modified:
+                session.searched[side].clear()
+            if _filter.flush is not None:
+                should_flush.append(_filter.flush)
+                combined.offset = combined.end
+
+            session.state = combined.state
+
+            if _filter.rule_type == 'admit':
+                break
+
+            # if we didn't match more content, stop processing
+            if current_offset == combined.offset:
+                break
+
+            pending = self._pending(side, pending[position:], modified,
+                                    state ^ combined.state)
+
+        return combined, matched, should_flush
+
+    def _pending(self, side, pending, modified, changed):
+        """
+        Determine which rules might match after a rule matched.
+
+        Arguments:
+            side: side of the traffic being analyzed
+            pending: indexes of the rules that were not shown to fail in the
+                last pass, starting with the rule that matched
+            modified: True if the content of the buffer was replaced
+            changed: bitmask of the state bits changed by the match
+
+        Returns:
+            A sorted list of the indexes of the rules that might match
+
+        Raises:
+            None
+        """
+        if modified:
+            return range(len(self.side_filters[side]))
+
+        pending = set(pending)
+        pending.update(self.offset_dependent[side])
+        if changed:
+            for mask, readers in self.state_readers[side].iteritems():
+                if changed & mask:
+                    pending.update(readers)
+        return sorted(pending)
+
+    def _evaluate_reference(self, session, side, combined):
+        """
+        Evaluate every rule against the inspection buffer, starting over from
+        the first rule after each match.  This is the simplest implementation
+        of the rule semantics, and is used to validate _evaluate.
+
+        Arguments:
+            session: Session being analyzed
+            side: side of the traffic being analyzed
+            combined: FilterData of the inspection buffer
+
+        Returns:
+            A tuple of the evaluated FilterData, a list of the names of the
+                rules that matched, and a list of the sides to be flushed
+
+        Raises:
+            NetworkFilterException if a 'block' rule matched
+        """
         matched = []
         recent_matched = []
 
@@ -248,19 +1101,8 @@ class NetworkFilter(base.FilterBaseClass):
         while True:
             current_offset = combined.offset
             for _filter in self.filters:
-                state = copy.copy(self.sessions[session]['state'])
-
-                offset = combined.offset
-                try:
-                    ret = _filter.evaluate(state, side, combined)
-                except base.NetworkFilterException:
-                    raise base.NetworkFilterException('filter matched %s: %s' %
-                                                      (repr(_filter.name),
-                                                       repr(combined.seen())))
+                ret = self._check(_filter, side, combined)
                 if ret is None:
-                    logging.debug('filter did not match %s: %s',
-                                  repr(_filter.name), repr(str(combined)))
-                    combined.offset = offset
                     continue
 
                 # 'admit' rules parse traffic, but don't generate logs
@@ -269,9 +1111,9 @@ class NetworkFilter(base.FilterBaseClass):
                 combined = ret
                 if _filter.flush is not None:
                     should_flush.append(_filter.flush)
-                    combined.offset += len(str(combined))
-                
-                self.sessions[session]['state'] = state
+                    combined.offset = combined.end
+
+                session.state = combined.state
 
                 # a rule matched.  continued analysis should happen from the beginning of the list
                 break
@@ -286,17 +1128,7 @@ class NetworkFilter(base.FilterBaseClass):
             if current_offset == combined.offset:
                 break
 
-        orig_len = len(self.sessions[session][side])
-        self.sessions[session][side] = str(combined)
-
-        for flush in should_flush:
-            self.sessions[session][flush] = ''
-
-        if self.debug:
-            for side in self.sessions[session]:
-                logging.debug('buffer %s : %s' % (repr(side), repr(self.sessions[session][side])))
-
-        return combined.data_after(orig_len), matched
+        return combined, matched, should_flush
 
 
 def main():
@@ -37,23 +37,141 @@ class FilterData(object):
     A string class intended to be used for passing around current offsets, and
     handling in-place content modification
 
+    Searching and matching are performed against 'data' starting at 'offset',
+    rather than on a copy of the remaining data.  Modifications are made in
+    place, and recorded in an ordered patch log such that they can be undone.
+
+    The data being analyzed may be a window ('start' to 'end') of a larger
+    bytearray, such as the storage of an InspectionWindow.  Offsets are
+    always offsets into the underlying bytearray.
+
     Attributes:
-        data: underlying str data
+        data: underlying bytearray data
+        start: offset into 'data' of the start of the data being analyzed
+        end: offset into 'data' of the end of the data being analyzed
         offset: current offset into 'data' that has been evaluated
+        state: session state bitmask, as updated by 'state' rule options
+        patches: list of (offset, original content) for each modification,
+            in the order they were made
+        open_ended: set by rule options whose result could change if more
+            data were appended after 'end'
+        searched: dict of search key to (stream offset the search started
+            from, stream offset to resume it from), for searches that did not
+            find their string, or None to always search all of the data
+        position: offset into the stream of the start of 'data', such that
+            'offset + position' is the offset of 'offset' into the stream
     """
-    def __init__(self, data):
+    def __init__(self, data, state=0, start=0, end=None):
+        if not isinstance(data, bytearray):
+            data = bytearray(data)
+        if end is None:
+            end = len(data)
+        assert 0 <= start <= end <= len(data)
         self.data = data
-        self.offset = 0
+        self.start = start
+        self.end = end
+        self.offset = start
+        self.state = state
+        self.patches = []
+        self.open_ended = False
+        self.searched = None
+        self.position = 0
 
     def __str__(self):
-        return self.data[self.offset:]
+        return str(self.data[self.offset:self.end])
 
     def __len__(self):
-        return len(self.data)
+        return self.end - self.start
 
     def __repr__(self):
-        return '<FilterData: string:%s offset:%d>' % (repr(self.data),
-                                                      self.offset)
+        return '<FilterData: string:%s offset:%d state:%d>' % (
+            repr(str(self.data[self.start:self.end])),
+            self.offset - self.start, self.state)
+
+    def find(self, string, depth=None):
+        """
+        Find a string in the data after the current offset
+
+        Arguments:
+            string: the string to find
+            depth: if provided, the string must be entirely within this many
+                bytes of the current offset
+
+        Returns:
+            The offset into 'data' of the string, or -1 if it is not found
+
+        Raises:
+            None
+        """
+        end = self.end
+        if depth is not None:
+            end = min(self.offset + depth, end)
+        return self.data.find(string, self.offset, end)
+
+    def search(self, key, string):
+        """
+        Find a string in the data after the current offset, like find().  If
+        the previous search with the same key started from the same offset
+        and did not find the string, only the data it did not search (and
+        enough before it for a string that crosses the boundary) is searched.
+
+        The data that was searched must not have been modified since, which
+        the owner of 'searched' ensures by clearing it.
+
+        Arguments:
+            key: identifies the search, such as the rule option
+            string: the string to find
+
+        Returns:
+            The offset into 'data' of the string, or -1 if it is not found
+
+        Raises:
+            None
+        """
+        if self.searched is None:
+            return self.data.find(string, self.offset, self.end)
+
+        begin = self.offset + self.position
+        start = self.offset
+        resume = self.searched.get(key)
+        if resume is not None and resume[0] == begin:
+            start = max(start, resume[1] - self.position)
+
+        offset = self.data.find(string, start, self.end)
+        if offset == -1:
+            self.searched[key] = (begin, self.end + self.position -
+                                  len(string) + 1)
+        return offset
+
+    def match(self, regex, positional=True):
+        """
+        Match a compiled regular expression at the current offset
+
+        Arguments:
+            regex: the compiled regular expression
+            positional: False if the regular expression depends on the data
+                before the offset (such as '^' or '\\b'), in which case the
+                remaining data is copied to match against
+
+        Returns:
+            The offset into 'data' of the end of the match, or None if the
+                regular expression does not match
+
+        Raises:
+            None
+        """
+        # the re2 module can not report the offsets of a match against a
+        # bytearray, so the end is computed from the length of the match
+        if self.offset == self.end:
+            # the re2 module does not match when 'pos' is 'endpos'
+            match = regex.match('')
+        elif positional:
+            match = regex.match(self.data, self.offset, self.end)
+        else:
+            match = regex.match(self.data[self.offset:self.end])
+        if match is None:
+            return None
+        return self.offset + len(match.group(0))
 
     def seen(self):
         """
@@ -68,7 +186,7 @@ class FilterData(object):
         Raises:
             None
         """
-        return self.data[:self.offset]
+        return str(self.data[self.start:self.offset])
 
     def data_after(self, offset):
         """
@@ -83,19 +201,19 @@ class FilterData(object):
         Raises:
             None
         """
-        return self.data[offset:]
+        return str(self.data[offset:self.end])
 
     def modify(self, offset, data):
         """
-        Create a modified version of the FilterData instance, replacing content
-        at a specified offset into the buffer.
+        Replace content at a specified offset into the buffer, in place,
+        recording the original content in the patch log.
 
         Arguments:
             offset: Offset into the current buffer to start the replacement
             data: Data that should be used as a replacement
 
         Returns:
-            A FilterData instance that contains the modification
+            The FilterData instance, which contains the modification
 
         Raises:
             AssertionError if the offset isn't an integer
@@ -105,11 +223,162 @@ class FilterData(object):
         """
         assert isinstance(offset, int)
         assert isinstance(data, str)
-        assert offset + len(data) <= len(self.data)
-        updated = FilterData(self.data[:offset] + data +
-                             self.data[offset+len(data):])
-        updated.offset = self.offset
-        return updated
+        assert self.start <= offset
+        assert offset + len(data) <= self.end
+        end = offset + len(data)
+        self.patches.append((offset, str(self.data[offset:end])))
+        self.data[offset:end] = data
+        return self
+
+    def rollback(self, count):
+        """
+        Undo modifications, newest first, until only 'count' remain in the
+        patch log.
+
+        Arguments:
+            count: number of modifications to keep
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        while len(self.patches) > count:
+            offset, original = self.patches.pop()
+            self.data[offset:offset + len(original)] = original
+
+
+class InspectionWindow(object):
+    """
+    The retained inspection buffer for one side of a session.
+
+    Content is stored in a bytearray, between 'start' and 'end'.  Appending
+    writes after 'end', and trimming advances 'start', such that neither
+    copies the retained content.  When an append does not fit after 'end',
+    the retained content is moved to the front of the storage, which is
+    doubled (up to 'max_capacity') if the content fills more than half of
+    it.  This happens at most once per 'capacity - len(window)' appended
+    bytes.  The content is always contiguous, such that rules can search it
+    in place.
+
+    No storage is allocated until data is appended, and storage larger than
+    MIN_CAPACITY is freed once the window is empty, such that idle sessions
+    use little memory.
+
+    Attributes:
+        data: underlying bytearray storage
+        start: offset into 'data' of the start of the retained content
+        end: offset into 'data' of the end of the retained content
+        max_capacity: size the storage is grown to before the content is
+            moved to the front instead, or None for no limit.  Content
+            larger than this still grows the storage.
+    """
+    MIN_CAPACITY = 4096
+
+    def __init__(self, size=None):
+        self.max_capacity = None
+        if size is not None:
+            self.max_capacity = max(self.MIN_CAPACITY, size * 2)
+        self.data = bytearray()
+        self.start = 0
+        self.end = 0
+
+    def __str__(self):
+        return str(self.data[self.start:self.end])
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __repr__(self):
+        return '<InspectionWindow: %s>' % repr(str(self))
+
+    def append(self, data):
+        """
+        Add data to the end of the window
+
+        Arguments:
+            data: the str, bytearray or memoryview to add
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        size = len(data)
+        if self.end + size > len(self.data):
+            length = self.end - self.start
+            needed = length + size
+            capacity = len(self.data)
+            if needed * 2 > capacity:
+                capacity = max(self.MIN_CAPACITY, needed * 2)
+                if self.max_capacity is not None:
+                    capacity = max(min(capacity, self.max_capacity), needed)
+
+            if capacity == len(self.data):
+                self.data[:length] = self.data[self.start:self.end]
+            else:
+                storage = bytearray(capacity)
+                storage[:length] = memoryview(self.data)[self.start:self.end]
+                self.data = storage
+            self.start = 0
+            self.end = length
+        self.data[self.end:self.end + size] = data
+        self.end += size
+
+    def truncate(self, end):
+        """
+        Remove the data after an offset into the storage, such as data that
+        was appended for a chunk that was not accepted.
+
+        Arguments:
+            end: offset into 'data' of the new end of the window
+
+        Returns:
+            None
+
+        Raises:
+            AssertionError if 'end' is not within the window
+        """
+        assert self.start <= end <= self.end
+        self.end = end
+
+    def trim(self, amount):
+        """
+        Remove data from the start of the window
+
+        Arguments:
+            amount: number of bytes to remove
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        self.start = min(self.start + amount, self.end)
+        if self.start == self.end:
+            self.clear()
+
+    def clear(self):
+        """
+        Remove all of the data in the window, freeing storage larger than
+        MIN_CAPACITY
+
+        Arguments:
+            None
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        self.start = 0
+        self.end = 0
+        if len(self.data) > self.MIN_CAPACITY:
+            self.data = bytearray()
 
 
 class FilterBaseClass(object):
@@ -0,0 +1,296 @@
+#!/usr/bin/python
+
+"""
+Copyright (C) 2015 - Brian Caswell <bmc@lungetech.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import logging
+import struct
+import threading
+import time
+
+# message format:
+# 4 bytes - CSID
+# 4 bytes - connection ID
+# 4 bytes - message ID
+# 2 bytes - message length
+# 1 byte - version and side (version 1: side only)
+HEADER = struct.Struct('<LLLHB')
+HEADER_LEN = HEADER.size
+
+VERSION_1, VERSION_2 = (1, 2)
+VERSIONS = (VERSION_1, VERSION_2)
+
+# version 2 records the version in the high bits of the side byte.  version
+# 1 messages only have a side of 0 or 1 there, which reads as version 0.
+VERSION_SHIFT = 4
+SIDE_MASK = 0x0F
+
+# the most message content in a single log message.  version 1 collectors
+# expect at most 1024 bytes, version 2 allows the largest UDP payload.
+MAX_MESSAGE_SIZE = {
+    VERSION_1: 1024,
+    VERSION_2: 0xFFFF - 8 - 20 - HEADER_LEN,
+}
+
+
+def pack(csid, connection_id, message_id, side, message, version=VERSION_1):
+    """
+    Build a log message
+
+    Arguments:
+        csid: the challenge set id
+        connection_id: the connection id
+        message_id: the id of the message within the connection
+        side: the side the message content was sent to
+        message: the message content
+        version: the version of the message format
+
+    Returns:
+        The packed log message
+
+    Raises:
+        AssertionError if the version is not supported
+        AssertionError if the message is too large for the version
+    """
+    assert version in VERSIONS
+    assert len(message) <= MAX_MESSAGE_SIZE[version]
+    assert 0 <= side <= SIDE_MASK
+
+    flags = side
+    if version != VERSION_1:
+        flags |= version << VERSION_SHIFT
+    return HEADER.pack(csid, connection_id, message_id, len(message),
+                       flags) + message
+
+
+def parse(data, log_errors=True):
+    """
+    Parse a log message of any supported version
+
+    Arguments:
+        data: the log message
+        log_errors: if False, invalid messages are not logged
+
+    Returns:
+        A tuple of the version, csid, connection id, message id, side, and
+            message content, or None if the log message is invalid
+
+    Raises:
+        None
+    """
+    if len(data) < HEADER_LEN:
+        if log_errors:
+            logging.error('invalid message length: %d', len(data))
+        return None
+
+    csid, connection_id, msg_id, msg_len, flags = HEADER.unpack_from(data)
+    version = (flags >> VERSION_SHIFT) or VERSION_1
+    if version not in VERSIONS:
+        if log_errors:
+            logging.error('unsupported message version: %d', version)
+        return None
+
+    message = data[HEADER_LEN:]
+    if len(message) != msg_len:
+        if log_errors:
+            logging.error('invalid message.  actual: %d expected: %d',
+                          len(data), msg_len)
+        return None
+
+    return (version, csid, connection_id, msg_id, flags & SIDE_MASK, message)
+
+
+def split(data):
+    """
+    Split a stream of log messages, as sent over a stream transport, into
+    messages.  Messages are framed by the length in their header.
+
+    Arguments:
+        data: the data read from the stream
+
+    Returns:
+        A tuple of the list of complete messages, and the data after the
+            last complete message
+
+    Raises:
+        None
+    """
+    messages = []
+    offset = 0
+    while len(data) - offset >= HEADER_LEN:
+        msg_len = struct.unpack_from('<H', data, offset + HEADER_LEN - 3)[0]
+        end = offset + HEADER_LEN + msg_len
+        if end > len(data):
+            break
+        messages.append(data[offset:end])
+        offset = end
+    return messages, data[offset:]
+
+
+# pcap files hold each log message as the payload of a fake ethernet frame,
+# with an ethertype that the cgc.lua dissector is registered for
+PCAP_MAGIC = 0xa1b2c3d4L
+PCAP_VERSION_MAJOR = 2
+PCAP_VERSION_MINOR = 4
+PCAP_LINK_TYPE = 1
+PCAP_SNAPLEN = 0xFFFF
+ETHERNET_HEADER = '\x00' * 12 + '\xff\xff'
+
+
+def pcap_header():
+    """
+    Build the header of a pcap file
+
+    Arguments:
+        None
+
+    Returns:
+        The pcap file header
+
+    Raises:
+        None
+    """
+    return struct.pack('>IHHIIII', PCAP_MAGIC, PCAP_VERSION_MAJOR,
+                       PCAP_VERSION_MINOR, 0, 0, PCAP_SNAPLEN, PCAP_LINK_TYPE)
+
+
+def pcap_record(data, timestamp=None):
+    """
+    Build a pcap record of a log message
+
+    Arguments:
+        data: the log message, including its header
+        timestamp: the time the message was logged, or None for now
+
+    Returns:
+        The pcap record
+
+    Raises:
+        None
+    """
+    if timestamp is None:
+        timestamp = time.time()
+    tv_sec = int(timestamp)
+    tv_usec = int((timestamp - tv_sec) * 1000000.0)
+    packet_len = len(ETHERNET_HEADER) + len(data)
+    return (struct.pack('>IIII', tv_sec, tv_usec, packet_len, packet_len) +
+            ETHERNET_HEADER + data)
+
+
+class PcapWriter(object):
+    """
+    Writes log messages to a pcap file from a background thread.
+
+    Records are built as they are written, and collected in memory.  The
+    thread writes the collected records to the file in a single write once
+    'buffer_size' bytes are collected, or every 'interval' seconds.
+
+    Attributes:
+        filename: the pcap file
+        buffer_size: bytes of records collected before they are written
+        interval: the most seconds records are collected before they are
+            written
+        records: the number of records written
+    """
+    BUFFER_SIZE = 0x100000
+    INTERVAL = 1.0
+
+    def __init__(self, filename, buffer_size=BUFFER_SIZE, interval=INTERVAL):
+        assert buffer_size > 0
+        assert interval > 0
+        self.filename = filename
+        self.buffer_size = buffer_size
+        self.interval = interval
+        self.records = 0
+
+        self._handle = open(filename, 'wb')
+        self._handle.write(pcap_header())
+        self._handle.flush()
+
+        self._pending = []
+        self._pending_size = 0
+        # the lock is held directly where possible, as entering the
+        # Condition is much slower
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, data, timestamp=None):
+        """
+        Add a log message to the pcap file
+
+        Arguments:
+            data: the log message, including its header
+            timestamp: the time the message was logged, or None for now
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        record = pcap_record(data, timestamp)
+        with self._lock:
+            self._pending.append(record)
+            self._pending_size += len(record)
+            if self._pending_size >= self.buffer_size:
+                self._ready.notify()
+
+    def _run(self):
+        while True:
+            with self._ready:
+                if not self._stopping and self._pending_size < self.buffer_size:
+                    self._ready.wait(self.interval)
+                pending = self._pending
+                stopping = self._stopping
+                self._pending = []
+                self._pending_size = 0
+
+            if len(pending):
+                self._handle.write(''.join(pending))
+                self._handle.flush()
+                self.records += len(pending)
+
+            if stopping:
+                return
+
+    def close(self):
+        """
+        Write the collected records, and close the file
+
+        Arguments:
+            None
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        with self._ready:
+            self._stopping = True
+            self._ready.notify()
+        self._thread.join()
+        self._handle.close()
@@ -0,0 +1,287 @@
+#!/usr/bin/python
+
+"""
+Copyright (C) 2015 - Brian Caswell <bmc@lungetech.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+# pylint: disable=too-few-public-methods
+
+import re2 as re
+
+
+class LiteralSet(object):
+    """
+    The literal strings used by 'match' rule options, used to find where each
+    literal was last seen in a buffer.
+
+    Only the data added since the previous scan is searched, plus enough of
+    the data before it to find literals that cross the boundary between two
+    chunks.  Each literal is first searched for with re2, which is much
+    faster than rfind at finding that a literal is not in the data, and does
+    not hold the GIL.  The literals that are found are then searched for
+    with rfind, to find their last occurrence.
+
+    Attributes:
+        literals: list of unique literal strings, indexed by literal id
+    """
+    def __init__(self, literals=None):
+        self.literals = []
+        self._ids = {}
+        self._search = []
+
+        if literals is not None:
+            for literal in literals:
+                self.add(literal)
+
+    def __len__(self):
+        return len(self.literals)
+
+    def __repr__(self):
+        return '<LiteralSet %s>' % repr(self.literals)
+
+    def add(self, literal):
+        """
+        Add a literal to the set
+
+        Arguments:
+            literal: the string to add
+
+        Returns:
+            The literal id of the string
+
+        Raises:
+            AssertionError if the literal is not a non-empty string
+        """
+        assert isinstance(literal, str)
+        assert len(literal) > 0
+
+        if literal in self._ids:
+            return self._ids[literal]
+
+        # re2 matches strings as UTF-8, which only matches every byte as
+        # itself for ASCII
+        regex = None
+        if max(literal) < '\x80':
+            regex = re.compile(re.escape(literal))
+            if not isinstance(regex, type(re.compile(''))):
+                regex = None
+
+        literal_id = len(self.literals)
+        self._ids[literal] = literal_id
+        self.literals.append(literal)
+        self._search.append((literal_id, literal, len(literal) - 1, regex))
+        return literal_id
+
+    def scan(self, data, start=0, hits=None, base=0, end=None, position=0):
+        """
+        Scan data for every literal in the set
+
+        Arguments:
+            data: the string (or bytearray) to scan
+            start: offset into data of the first byte that was not scanned
+                before.  Only literals that end at or after this offset are
+                found.
+            hits: dict of literal id to the position of the start of the
+                last occurrence of the literal, updated in place
+            base: offset into data of the start of the buffer.  The data
+                before it is not scanned.
+            end: offset into data of the end of the buffer, or None for the
+                end of data
+            position: the position of the start of the buffer, such as its
+                offset into a stream
+
+        Returns:
+            The updated hits dict
+
+        Raises:
+            None
+        """
+        if hits is None:
+            hits = {}
+        if end is None:
+            end = len(data)
+
+        position -= base
+        for literal_id, literal, overlap, regex in self._search:
+            first = max(base, start - overlap)
+            if regex is not None and regex.search(data, first, end) is None:
+                continue
+            offset = data.rfind(literal, first, end)
+            if offset != -1:
+                hits[literal_id] = offset + position
+
+        return hits
+
+
+class RegexSet(object):
+    """
+    A set of regular expressions that are matched against the same position
+    in a buffer with a single scan.
+
+    If the re2 module provides RE2::Set (re2.Set), every pattern that matches
+    is reported.  Otherwise, the patterns are combined into a single
+    alternation of named groups.  RE2 prefers the earliest alternative that
+    matches, which identifies the first pattern that matches, and proves
+    that none of the patterns before it match.
+
+    Patterns that re2 can not handle natively (for example, backreferences
+    that the re2 module implements with the 're' module) are not added to
+    the set.  Patterns are matched at an offset into the data, so patterns
+    that depend on the data before the offset (such as '^') should not be
+    added to the set.
+
+    Attributes:
+        patterns: list of the regular expressions in the set
+        regex: the compiled RE2::Set or alternation, or None if no patterns
+            were added to the set
+    """
+    GROUP_NAME = '_regex_set_%d'
+
+    def __init__(self, patterns=None):
+        self.patterns = []
+        self.regex = None
+        self._groups = []
+        self._native = type(re.compile(''))
+        self._is_set = hasattr(re, 'Set')
+
+        if patterns is not None:
+            for pattern in patterns:
+                self.add(pattern)
+            self.compile()
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def __repr__(self):
+        return '<RegexSet %s>' % repr(self.patterns)
+
+    def add(self, pattern):
+        """
+        Add a regular expression to the set.  compile() must be called once
+        all of the patterns have been added.
+
+        Arguments:
+            pattern: the regular expression string
+
+        Returns:
+            The index of the pattern in the set, or None if the pattern can
+                not be handled by the set
+
+        Raises:
+            None
+        """
+        try:
+            if not isinstance(re.compile(pattern), self._native):
+                return None
+        except re.error:
+            return None
+
+        self.patterns.append(pattern)
+        return len(self.patterns) - 1
+
+    def compile(self):
+        """
+        Compile the patterns into an RE2::Set, or an alternation of named
+        groups if re2.Set is not available.
+
+        Arguments:
+            None
+
+        Returns:
+            None
+
+        Raises:
+            None
+        """
+        self.regex = None
+        if not len(self.patterns):
+            return
+
+        if self._is_set:
+            regex = re.Set.MatchSet()
+            for pattern in self.patterns:
+                regex.Add(pattern)
+            regex.Compile()
+            self.regex = regex
+            return
+
+        alternatives = []
+        for index, pattern in enumerate(self.patterns):
+            alternatives.append('(?P<%s>%s)' % (self.GROUP_NAME % index,
+                                                pattern))
+        try:
+            regex = re.compile('|'.join(alternatives))
+        except re.error:
+            self.patterns = []
+            return
+
+        if not isinstance(regex, self._native):
+            self.patterns = []
+            return
+
+        self.regex = regex
+        self._groups = [self.GROUP_NAME % index
+                        for index in range(len(self.patterns))]
+
+    def match(self, data, offset=0, end=None):
+        """
+        Match every pattern in the set at an offset into data
+
+        Arguments:
+            data: the string (or bytearray) to match against
+            offset: the offset into data to match at
+            end: the offset into data of the end of the data to match, or
+                None for the end of data
+
+        Returns:
+            A tuple of the set of indexes of patterns known to match, and the
+                number of patterns the result covers.  Any pattern with an
+                index before this count that is not in the set does not
+                match.  Nothing is known about patterns after the count.
+
+        Raises:
+            None
+        """
+        if self.regex is None:
+            return frozenset(), 0
+
+        if end is None:
+            end = len(data)
+
+        if self._is_set:
+            return (frozenset(self.regex.Match(data[offset:end])),
+                    len(self.patterns))
+
+        if offset == end:
+            # the re2 module does not match when 'pos' is 'endpos'
+            match = self.regex.match('')
+        else:
+            match = self.regex.match(data, offset, end)
+        if match is None:
+            return frozenset(), len(self.patterns)
+
+        # the re2 module can not report the offsets of a match against a
+        # bytearray, but does report the content of each group
+        for index, group in enumerate(self._groups):
+            if match.group(group) is not None:
+                return frozenset([index]), index + 1
+
+        return frozenset(), 0
@@ -25,6 +25,7 @@ THE SOFTWARE.
 # pylint: disable=too-few-public-methods
 
 import re2 as re
+import sre_parse
 import string
 from . import base
 
@@ -41,17 +42,27 @@ class FilterSkip(base.FilterBaseClass):
     def __repr__(self):
         return '[FilterSkip offset=%d]' % self.offset
 
-    def cb_check(self, state, side, data):
+    def cb_check(self, side, data):
         """
         Call back for evalating 'skip' rule options.
 
         Advance the 'offset', as long as the offset is within the buffer.
         """
-        if data.offset + self.offset > len(data):
+        if data.offset + self.offset > data.end:
+            data.open_ended = True
             return None
         data.offset += self.offset
         return data
 
+    def cb_source(self, name, bindings):
+        """
+        Source for the 'skip' rule option, for use by Filter.compile
+        """
+        return ['if data.offset + %d > data.end:' % self.offset,
+                '    data.open_ended = True',
+                '    return None',
+                'data.offset += %d' % self.offset]
+
 
 class FilterBlock(base.FilterBaseClass):
     """
@@ -61,7 +72,7 @@ class FilterBlock(base.FilterBaseClass):
         return '[FilterBlock]'
 
     @staticmethod
-    def cb_check(state, side, data):
+    def cb_check(side, data):
         """
         Call back for the 'block' rule option.
 
@@ -70,6 +81,14 @@ class FilterBlock(base.FilterBaseClass):
         """
         raise base.NetworkFilterException('drop connection')
 
+    @staticmethod
+    def cb_source(name, bindings):
+        """
+        Source for the 'block' rule option, for use by Filter.compile
+        """
+        bindings['NetworkFilterException'] = base.NetworkFilterException
+        return ["raise NetworkFilterException('drop connection')"]
+
 
 class FilterSide(base.FilterBaseClass):
     """
@@ -95,7 +114,7 @@ class FilterSide(base.FilterBaseClass):
     def __repr__(self):
         return '[FilterSide %s]' % (self._get_side(self.side))
 
-    def cb_check(self, state, side, data):
+    def cb_check(self, side, data):
         """
         Call back for the 'side' rule option.
 
@@ -106,10 +125,23 @@ class FilterSide(base.FilterBaseClass):
             return data
         return None
 
+    def cb_source(self, name, bindings):
+        """
+        Source for the 'side' rule option, for use by Filter.compile
+        """
+        return ['if side != %d:' % self.side,
+                '    return None']
+
 
 class FilterState(base.FilterBaseClass):
     """
     Per-session named bitmask
+
+    Attributes:
+        keyword: set, unset, is, or not
+        name: name of the state
+        mask: bit in the session state bitmask used for 'name', assigned by
+            NetworkFilter when the rules are loaded
     """
     def __init__(self, option):
 
@@ -125,31 +157,46 @@ class FilterState(base.FilterBaseClass):
         assert isinstance(name, str)
         assert len(name) > 0
         self.name = name
+        self.mask = None
 
     def __repr__(self):
         return '[FilterState %s:%s]' % (self.keyword, self.name)
 
-    def cb_check(self, state, side, data):
+    def cb_check(self, side, data):
         """
         Call back for the 'state' rule option.
 
-        If the rule option side matches the side of the curernt data,
-        continue processing.  Otherwise the rule stops processing.
+        Set or unset the state bit in the session state bitmask carried by
+        'data', or continue processing only if the bit is set (or unset).
         """
         if self.keyword == 'set':
-            state[self.name] = True
+            data.state |= self.mask
             return data
         elif self.keyword == 'unset':
-            state[self.name] = False
+            data.state &= ~self.mask
             return data
         elif self.keyword == 'is':
-            if self.name in state and state[self.name]:
+            if data.state & self.mask:
                 return data
         elif self.keyword == 'not':
-            if self.name not in state or not state[self.name]:
+            if not data.state & self.mask:
                 return data
         return None
 
+    def cb_source(self, name, bindings):
+        """
+        Source for the 'state' rule option, for use by Filter.compile
+        """
+        if self.keyword == 'set':
+            return ['data.state |= %d' % self.mask]
+        elif self.keyword == 'unset':
+            return ['data.state &= %d' % ~self.mask]
+        elif self.keyword == 'is':
+            return ['if not data.state & %d:' % self.mask,
+                    '    return None']
+        return ['if data.state & %d:' % self.mask,
+                '    return None']
+
 
 class FilterMatch(base.FilterBaseClass):
     """
@@ -216,7 +263,7 @@ class FilterMatch(base.FilterBaseClass):
         return '[FilterMatch: string:%s depth:%s]' % (repr(self.string),
                                                       repr(self.depth))
 
-    def cb_check(self, state, side, data):
+    def cb_check(self, side, data):
         """
         Call back for the 'match' rule option.
 
@@ -224,18 +271,20 @@ class FilterMatch(base.FilterBaseClass):
         buffer, replacing the value if a following 'replace' rule option
         exists.
         """
-        raw_data = str(data)
-
-        if self.depth is not None:
-            raw_data = raw_data[:self.depth]
-
-        # print "CHECKING", repr(raw_data), repr(self.string)
-        try:
-            offset = raw_data.index(self.string)
-        except ValueError:
+        # a search without a depth resumes where it failed before, such that
+        # only new data is searched
+        if self.depth is None:
+            offset = data.search(self, self.string)
+        else:
+            offset = data.find(self.string, self.depth)
+        if offset == -1:
+            # the first occurrence does not change as data is appended, but
+            # the string could still be found in appended data
+            if self.depth is None or data.offset + self.depth > data.end:
+                data.open_ended = True
             return None
 
-        data.offset += offset
+        data.offset = offset
 
         if self.replace is not None:
             data = data.modify(data.offset, self.replace)
@@ -244,10 +293,45 @@ class FilterMatch(base.FilterBaseClass):
 
         return data
 
+    def cb_source(self, name, bindings):
+        """
+        Source for the 'match' rule option, for use by Filter.compile
+        """
+        if self.depth is None:
+            bindings[name] = self
+            search = 'data.search(%s, %r)' % (name, self.string)
+            open_ended = 'True'
+        else:
+            search = ('data.data.find(%r, data.offset, '
+                      'min(data.offset + %d, data.end))' % (self.string,
+                                                            self.depth))
+            open_ended = 'data.offset + %d > data.end' % self.depth
+
+        source = ['offset = %s' % search,
+                  'if offset == -1:',
+                  '    if %s:' % open_ended,
+                  '        data.open_ended = True',
+                  '    return None']
+        if self.replace is not None:
+            source.append('data.modify(offset, %r)' % self.replace)
+        source.append('data.offset = offset + %d' % len(self.string))
+        return source
+
 
 class FilterRegex(base.FilterBaseClass):
     """
     Perform a regular expression match on the input buffer
+
+    Attributes:
+        regex_string: the regular expression from the rule
+        pattern: the regular expression that is matched.  If possible, this
+            is 'regex_string' without a leading '^', such that it can be
+            matched at an offset into the buffer.
+        positional: True if 'pattern' can be matched at an offset into the
+            buffer, rather than against a copy of the remaining buffer
+        regex: the compiled 'pattern'
+        width: the maximum length in bytes of a match of 'pattern', or None
+            if it is unbounded or unknown
     """
     def __init__(self, option):
         assert isinstance(option, list)
@@ -258,20 +342,166 @@ class FilterRegex(base.FilterBaseClass):
 
         self.regex_string = value[1:-1]
         assert '"' not in self.regex_string, "embeded quotes not handled"
-        self.regex = re.compile(self.regex_string)
+
+        self.pattern = self._unanchor(self.regex_string)
+        self.positional = self.pattern is not None
+        if not self.positional:
+            self.pattern = self.regex_string
+        self.regex = re.compile(self.pattern)
+        self.width = self._width(self.pattern, self.regex)
+
+    @staticmethod
+    def _width(pattern, regex):
+        """
+        A regular expression matched at an offset only inspects the data up
+        to the maximum length of a match (and one more byte, for assertions
+        such as '$' or '\\b'), so further data can not change the result
+        once that much data is available.
+
+        sre_parse measures the width in characters, while re2 matches the
+        data as UTF-8, where a character is up to 4 bytes.  The width of a
+        pattern that can match a non-ASCII character is multiplied by 4.
+
+        Returns:
+            The maximum length of a match in bytes, or None if it is
+                unbounded, or can not be determined.  Patterns the re2
+                module does not handle natively (backreferences) are treated
+                as unbounded.
+        """
+        if not isinstance(regex, type(re.compile(''))):
+            return None
+        try:
+            parsed = sre_parse.parse(pattern)
+            width = parsed.getwidth()[1]
+        except (sre_parse.error, OverflowError, RuntimeError):
+            return None
+        if width >= sre_parse.MAXREPEAT:
+            return None
+        if (parsed.pattern.flags & sre_parse.SRE_FLAG_IGNORECASE or
+                not FilterRegex._ascii(parsed)):
+            width *= 4
+        return width
+
+    @staticmethod
+    def _ascii(parsed):
+        """
+        Check if a parsed regular expression only matches ASCII characters.
+        Any character ('.'), negated literals and classes, and the negated
+        categories ('\\D', '\\S', '\\W') match non-ASCII characters.
+
+        Returns:
+            True if the parsed pattern only matches ASCII characters
+        """
+        for opcode, value in parsed:
+            if opcode in (sre_parse.ANY, sre_parse.NOT_LITERAL,
+                          sre_parse.NEGATE):
+                return False
+            elif opcode == sre_parse.LITERAL:
+                if value > 0x7f:
+                    return False
+            elif opcode == sre_parse.RANGE:
+                if value[1] > 0x7f:
+                    return False
+            elif opcode == sre_parse.CATEGORY:
+                if value in (sre_parse.CATEGORY_NOT_DIGIT,
+                             sre_parse.CATEGORY_NOT_SPACE,
+                             sre_parse.CATEGORY_NOT_WORD):
+                    return False
+            elif opcode == sre_parse.IN:
+                if not FilterRegex._ascii(value):
+                    return False
+            elif opcode == sre_parse.BRANCH:
+                if not all(FilterRegex._ascii(branch) for branch in value[1]):
+                    return False
+            elif opcode in (sre_parse.SUBPATTERN, sre_parse.MAX_REPEAT,
+                            sre_parse.MIN_REPEAT, sre_parse.ASSERT,
+                            sre_parse.ASSERT_NOT):
+                if not FilterRegex._ascii(value[-1]):
+                    return False
+        return True
+
+    @staticmethod
+    def _unanchor(pattern):
+        """
+        The rule option matches the regular expression at the current offset
+        into the buffer.  When matching at an offset, rather than against a
+        copy of the remaining buffer, '^', '\\A', '\\b', and '\\B' see
+        the data before the offset.
+
+        A leading '^' is redundant, as the match is already anchored at the
+        offset, and is removed.  Anywhere else, these assertions (or the
+        multi-line flag) mean the pattern can not be matched at an offset.
+
+        Returns:
+            The pattern to match at an offset, or None if the pattern can not
+                be matched at an offset
+        """
+        if pattern.startswith('^'):
+            pattern = pattern[1:]
+
+        in_class = False
+        index = 0
+        while index < len(pattern):
+            char = pattern[index]
+            if char == '\\':
+                if not in_class and pattern[index+1:index+2] in ['A', 'b', 'B']:
+                    return None
+                index += 2
+                continue
+
+            if in_class:
+                if char == ']':
+                    in_class = False
+            elif char == '[':
+                in_class = True
+                # a leading ']' (or '^]') is a literal within the class
+                if pattern[index+1:index+2] == '^':
+                    index += 1
+                if pattern[index+1:index+2] == ']':
+                    index += 1
+            elif char == '^':
+                return None
+            elif pattern[index:index+2] == '(?':
+                end = index + 2
+                while end < len(pattern) and pattern[end] in string.letters:
+                    end += 1
+                if 'm' in pattern[index+2:end]:
+                    return None
+            index += 1
+
+        return pattern
 
     def __repr__(self):
         return '<FilterRegex: re:%s>' % (repr(self.regex_string))
 
-    def cb_check(self, state, side, data):
+    def cb_check(self, side, data):
         """
         Call back for the 'regex' rule option.
 
         Validate the regex of the rule option against the remaining
         content buffer.
         """
-        match = self.regex.match(str(data))
-        if match:
-            data.offset += match.end()
-            return data
-        return None
+        if self.width is None or data.end - data.offset <= self.width + 1:
+            data.open_ended = True
+        offset = data.match(self.regex, self.positional)
+        if offset is None:
+            return None
+        data.offset = offset
+        return data
+
+    def cb_source(self, name, bindings):
+        """
+        Source for the 'regex' rule option, for use by Filter.compile
+        """
+        bindings[name] = self.regex
+        source = []
+        if self.width is None:
+            source.append('data.open_ended = True')
+        else:
+            source += ['if data.end - data.offset <= %d:' % (self.width + 1),
+                       '    data.open_ended = True']
+        source += ['offset = data.match(%s, %r)' % (name, self.positional),
+                   'if offset is None:',
+                   '    return None',
+                   'data.offset = offset']
+        return source
@@ -0,0 +1,105 @@
+#!/usr/bin/python
+
+"""
+Copyright (C) 2015 - Brian Caswell <bmc@lungetech.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+# Compares the throughput of NetworkFilter with and without the prefilters,
+# for each of the example rulesets:
+#
+#   python tests/bench_prefilter.py [--chunk_size N] [--buffer_size N]
+
+import argparse
+import glob
+import random
+import string
+import sys
+import time
+sys.path = ['.'] + sys.path
+
+import ids
+from ids import rule_options
+
+
+def traffic(network_filter, size):
+    """ Lines of random printable text, with the 'match' strings of the
+    rules mixed in """
+    rand = random.Random(0)
+    literals = [option.string for _filter in network_filter.filters
+                for option in _filter.options
+                if isinstance(option, rule_options.FilterMatch)]
+    chars = string.letters + string.digits + ' '
+
+    data = []
+    length = 0
+    while length < size:
+        line = ''.join(rand.choice(chars)
+                       for _ in range(rand.randint(10, 100)))
+        if len(literals) and rand.randint(0, 200) == 0:
+            line += rand.choice(literals)
+        data.append(line + '\n')
+        length += len(line) + 1
+    return ''.join(data)[:size]
+
+
+def run(network_filter, data, chunk_size):
+    """ Evaluate the data from each side of a session, returning MB/s """
+    start = time.clock()
+    for side in (network_filter.CLIENT, network_filter.SERVER):
+        for offset in range(0, len(data), chunk_size):
+            try:
+                network_filter(0, side, data[offset:offset + chunk_size])
+            except ids.base.NetworkFilterException:
+                network_filter.close(0)
+    network_filter.close(0)
+    return len(data) * 2 / (time.clock() - start) / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the prefilters')
+    parser.add_argument('--chunk_size', type=int, default=0x1000)
+    parser.add_argument('--buffer_size', type=int, default=0x2000)
+    parser.add_argument('--size', type=int, default=0x200000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print '%-28s %12s %12s' % ('rules', 'prefilter', 'no prefilter')
+    for filename in sorted(glob.glob('examples/*.rules')):
+        with open(filename) as rules_fh:
+            rules = rules_fh.read()
+
+        filters = [ids.NetworkFilter(rules, args.buffer_size,
+                                     prefilter=prefilter)
+                   for prefilter in (True, False)]
+        data = traffic(filters[0], args.size)
+
+        # the best of several interleaved runs, alternating which runs
+        # first, to reduce the noise from other load on the system
+        results = [0, 0]
+        for count in range(args.repeat):
+            for index in (count % 2, 1 - count % 2):
+                results[index] = max(results[index],
+                                     run(filters[index], data,
+                                         args.chunk_size))
+        print '%-28s %7.1f MB/s %7.1f MB/s' % ((filename,) + tuple(results))
+
+if __name__ == '__main__':
+    main()
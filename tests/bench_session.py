@@ -0,0 +1,82 @@
+#!/usr/bin/python
+
+"""
+Copyright (C) 2015 - Brian Caswell <bmc@lungetech.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+# Measures the cost of each chunk as a single session grows, for rules whose
+# 'match' keeps failing until the end of the session.  The cost per byte
+# should stay the same from the start of the session to the end:
+#
+#   python tests/bench_session.py [--chunk_size N] [--chunks N]
+
+import argparse
+import sys
+import time
+sys.path = ['.'] + sys.path
+
+import ids
+
+RULES = [
+    ('match, regex', 'alert (name:"a"; match:"Q"; regex:"B{2}C";)', ''),
+    ('match, match', 'alert (name:"a"; match:"Y"; match:"X";)', 'XY'),
+]
+
+
+def run(rules, first, chunk_size, chunks, prefilter):
+    """ Feed chunks of a session to the rules, returning the microseconds
+    per kilobyte for each quarter of the session """
+    network_filter = ids.NetworkFilter(rules, None, prefilter=prefilter)
+    side = network_filter.CLIENT
+    if len(first):
+        network_filter(0, side, first)
+    chunk = 'z' * chunk_size
+
+    results = []
+    quarter = max(chunks / 4, 1)
+    for _ in range(4):
+        start = time.clock()
+        for _ in range(quarter):
+            network_filter(0, side, chunk)
+        elapsed = time.clock() - start
+        results.append(elapsed * 1e6 / (quarter * chunk_size / 1024.0))
+    network_filter.close(0)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark long sessions')
+    parser.add_argument('--chunk_size', type=int, default=0x400)
+    parser.add_argument('--chunks', type=int, default=4000)
+    args = parser.parse_args()
+
+    print '%-28s %8s %8s %8s %8s  (us/KB)' % ('rules', 'first', 'second',
+                                             'third', 'fourth')
+    for name, rules, first in RULES:
+        for prefilter in (True, False):
+            results = run(rules, first, args.chunk_size, args.chunks,
+                          prefilter)
+            label = '%s%s' % (name, '' if prefilter else ', no prefilter')
+            print '%-28s %8.1f %8.1f %8.1f %8.1f' % ((label,) +
+                                                     tuple(results))
+
+if __name__ == '__main__':
+    main()
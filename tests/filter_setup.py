@@ -63,7 +63,8 @@ class BaseClass(object):
         """ Stop the running cb-proxy, cleanup all of the potential state, and
         return any output from cb-proxy """
         if self.process is not None:
-            self.process.terminate()
+            if self.process.poll() is None:
+                self.process.terminate()
             self.process.wait()
             self.process = None
 
@@ -88,7 +89,19 @@ class BaseClass(object):
                      negotiate=False,
                      buffer_size=None,
                      pcap_host=None,
-                     pcap_port=None):
+                     pcap_port=None,
+                     workers=None,
+                     engine=None,
+                     eval_threads=None,
+                     read_size=None,
+                     high_water=None,
+                     splice=False,
+                     pcap_version=None,
+                     pcap_message_size=None,
+                     pcap_transport=None,
+                     pcap_path=None,
+                     pcap_file=None,
+                     drain_timeout=None):
         """ Start cb-proxy in the background """
         assert self.process is None
         assert self.threads == []
@@ -129,6 +142,42 @@ class BaseClass(object):
         if pcap_port:
             cmd += ['--pcap_port', '%d' % pcap_port]
 
+        if workers is not None:
+            cmd += ['--workers', '%d' % workers]
+
+        if engine is not None:
+            cmd += ['--engine', engine]
+
+        if eval_threads is not None:
+            cmd += ['--eval_threads', '%d' % eval_threads]
+
+        if read_size is not None:
+            cmd += ['--read_size', '%d' % read_size]
+
+        if high_water is not None:
+            cmd += ['--high_water', '%d' % high_water]
+
+        if splice:
+            cmd += ['--splice']
+
+        if pcap_version is not None:
+            cmd += ['--pcap_version', '%d' % pcap_version]
+
+        if pcap_message_size is not None:
+            cmd += ['--pcap_message_size', '%d' % pcap_message_size]
+
+        if pcap_transport is not None:
+            cmd += ['--pcap_transport', pcap_transport]
+
+        if pcap_path is not None:
+            cmd += ['--pcap_path', pcap_path]
+
+        if pcap_file is not None:
+            cmd += ['--pcap_file', pcap_file]
+
+        if drain_timeout is not None:
+            cmd += ['--drain_timeout', '%f' % drain_timeout]
+
         print ' '.join(cmd)
         self.process = subprocess.Popen(cmd,
                                         stdout=subprocess.PIPE,
@@ -22,9 +22,12 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
+import errno
 import unittest
 import os
+import socket
 import sys
+import time
 
 sys.path = ['.'] + sys.path
 os.environ['PYTHONPATH'] = ':'.join(sys.path)
@@ -92,6 +95,339 @@ class TestFilter(filter_setup.BaseClass, unittest.TestCase):
             self.assertIn(" INFO : proxying connection from ('127.0.0.1', ",
                           result)
 
+    @timeout(20)
+    def test_large_transfer(self):
+        # the server does not read until everything has been sent, such that
+        # the proxy queues most of the data
+        self.start_filter('/dev/null')
+        server = self.start_server()
+        client = self.start_client()
+        server_client = server.accept()[0]
+        self.sockets.append(server_client)
+
+        data = ''.join(self.random_string(0x1000) for _ in range(512))
+        self.assertEqual(self.send_all(client, data), len(data))
+        self.assertEqual(self.recv_size(server_client, len(data)), data)
+        self.stop_filter()
+
+    @timeout(10)
+    def test_read_size(self):
+        # matches are found across the boundaries of small reads
+        self.write_rules('alert (name:"found"; match:"AAAA";)\n'
+                         'block (name:"blocked"; match:"BLOCK";)')
+        self.start_filter(read_size=3)
+        server = self.start_server()
+        client = self.start_client()
+        server_client = server.accept()[0]
+        self.sockets.append(server_client)
+
+        data = 'xAAAAx' * 100
+        self.send_all(client, data)
+        self.assertEqual(self.recv_size(server_client, len(data)), data)
+
+        data = self.random_string(0x10000).replace('A', 'x')
+        self.send_all(server_client, data)
+        self.assertEqual(self.recv_size(client, len(data)), data)
+
+        # depending on the adapted read size, the start of the match may
+        # have been forwarded before the connection is blocked
+        self.send_all(client, 'BLOCK')
+        self.assertIn(self.recv_size(server_client, 5), ['', 'B', 'BL', 'BLO',
+                                                         'BLOC'])
+
+        results = self.stop_filter()
+        found = [x for x in results if "filter matched: 'found'" in x]
+        self.assertEqual(len(found), 100)
+        blocked = [x for x in results if 'blocking connection' in x]
+        self.assertEqual(len(blocked), 1)
+
+    def _fill(self, high_water):
+        """ Send to a server that is not reading, until the proxy stops
+        accepting data, returning the number of bytes sent """
+        self.start_filter('/dev/null', high_water=high_water)
+        server = self.start_server()
+        client = self.start_client()
+        server_client = server.accept()[0]
+        self.sockets.append(server_client)
+
+        limit = 0x8000000
+        chunk = 'A' * 0x10000
+        client.setblocking(0)
+        sent = 0
+        idle = 0
+        while sent < limit and idle < 20:
+            try:
+                sent += client.send(chunk)
+                idle = 0
+            except socket.error as error:
+                self.assertEqual(error.errno, errno.EAGAIN)
+                idle += 1
+                time.sleep(0.05)
+
+        # everything that was accepted is still delivered
+        if sent < limit:
+            self.assertEqual(len(self.recv_size(server_client, sent)), sent)
+        self.stop_filter()
+        return sent, limit
+
+    @timeout(30)
+    def test_high_water(self):
+        sent, limit = self._fill(0x10000)
+        self.assertLess(sent, limit)
+
+    @timeout(30)
+    def test_no_high_water(self):
+        sent, limit = self._fill(0)
+        self.assertGreaterEqual(sent, limit)
+
+    @timeout(20)
+    def test_splice(self):
+        # server data is spliced, as there are no server rules, while
+        # client data is still inspected
+        self.write_rules('block (name:"blocked"; side:client; '
+                         'match:"BLOCK";)')
+        self.start_filter(splice=True)
+        server = self.start_server()
+        client = self.start_client()
+        server_client = server.accept()[0]
+        self.sockets.append(server_client)
+
+        for _ in range(3):
+            data = self.random_string(30).replace('B', 'A')
+            self.send_all(client, data)
+            self.assertEqual(self.recv_size(server_client, len(data)), data)
+
+            data = ''.join(self.random_string(0x1000) for _ in range(256))
+            self.send_all(server_client, data)
+            self.assertEqual(self.recv_size(client, len(data)), data)
+
+        self.send_all(client, 'BLOCK')
+        self.assertEqual(self.recv_size(server_client, 5), '')
+
+        results = self.stop_filter()
+        blocked = [x for x in results if 'blocking connection' in x]
+        self.assertEqual(len(blocked), 1)
+
+    @timeout(20)
+    def test_splice_finished(self):
+        # client data is inspected until no rule can match it, and spliced
+        # after that, while server data is still inspected
+        self.write_rules('alert (name:"login"; side:client; state:not,done; '
+                         'match:"USER"; state:set,done;)\n'
+                         'block (name:"blocked"; side:server; '
+                         'match:"BLOCK";)')
+        self.start_filter(splice=True)
+        server = self.start_server()
+        client = self.start_client()
+        server_client = server.accept()[0]
+        self.sockets.append(server_client)
+
+        for data in ['USER a\r\n', 'USER b\r\n']:
+            self.send_all(client, data)
+            self.assertEqual(self.recv_size(server_client, len(data)), data)
+
+        self.send_all(server_client, 'BLOCK')
+        self.assertEqual(self.recv_size(client, 5), '')
+
+        results = self.stop_filter()
+        spliced = [x for x in results if 'splicing' in x]
+        self.assertEqual(len(spliced), 1)
+        matched = [x for x in results if 'filter matched:' in x]
+        self.assertEqual(len(matched), 1)
+        blocked = [x for x in results if 'blocking connection' in x]
+        self.assertEqual(len(blocked), 1)
+
+    @timeout(10)
+    def test_splice_drain_timeout(self):
+        # the server stops reading and disconnects while data from the
+        # client is still in the splice pipe, which is given up on after
+        # the drain timeout
+        self.start_filter('/dev/null', max_connections=1, splice=True,
+                          drain_timeout=0.5)
+        server = self.start_server()
+        client = self.start_client()
+        server_client = server.accept()[0]
+        self.sockets.append(server_client)
+
+        # fill the socket buffers and the pipe, until the proxy stops
+        # reading from the client
+        client.setblocking(0)
+        data = self.random_string(0x10000)
+        for _ in range(2):
+            try:
+                while True:
+                    client.send(data)
+            except socket.error as error:
+                self.assertEqual(error.errno, errno.EAGAIN)
+            time.sleep(0.5)
+        server_client.shutdown(socket.SHUT_WR)
+
+        # the proxy exits once its only connection is closed
+        self.assertEqual(self.process.wait(), 0)
+        results = self.stop_filter()
+        expired = [x for x in results if 'not sent within' in x]
+        self.assertEqual(len(expired), 1)
+
+    @timeout(5)
+    def test_select_engine(self):
+        self.start_filter('/dev/null', engine='select')
+        server = self.start_server()
+        client = self.start_client()
+
+        server_client = server.accept()[0]
+        self.sockets.append(server_client)
+
+        data = self.random_string(30)
+        self.send_all(client, data)
+        self.assertEqual(server_client.recv(len(data)), data)
+
+        data = self.random_string(30)
+        self.send_all(server_client, data)
+        self.assertEqual(client.recv(len(data)), data)
+
+        results = self.stop_filter()
+        self.assertEqual(len(results), 1)
+
+    @timeout(5)
+    def test_connect_failed(self):
+        # no server is listening, the client is closed without being read
+        self.start_filter('/dev/null')
+        client = self.start_client()
+        self.send_all(client, self.random_string(30))
+
+        # closing with unread data resets the connection
+        try:
+            self.assertEqual(client.recv(10), '')
+        except socket.error as error:
+            self.assertEqual(error.errno, errno.ECONNRESET)
+
+        results = self.stop_filter()
+        self.assertEqual(len(results), 2, repr(results))
+        self.assertIn(" INFO : proxying connection from ('127.0.0.1', ",
+                      results[0])
+        self.assertIn(" INFO : closed connection from ('127.0.0.1', ",
+                      results[1])
+
+    @timeout(10)
+    def test_eval_threads(self):
+        self.write_rules(
+            'block (name:"blocked"; side:client; match:"BLOCK";)\n'
+            'alert (name:"replaced"; side:client; match:"AAAA"; '
+            'replace:"XXXX";)')
+        self.start_filter(eval_threads=2)
+
+        server = self.start_server()
+        pairs = []
+        for _ in range(5):
+            client = self.start_client()
+            server_client = server.accept()[0]
+            self.sockets.append(server_client)
+            pairs.append((client, server_client))
+
+        # chunks of each connection are forwarded in order
+        for _ in range(10):
+            for client, server_client in pairs:
+                self.send_all(client, 'AAAAB')
+            for client, server_client in pairs:
+                self.assertEqual(self.recv_size(server_client, 5), 'XXXXB')
+
+        client, server_client = pairs[0]
+        self.send_all(client, 'BLOCK')
+        self.assertEqual(server_client.recv(5), '')
+
+        results = self.stop_filter()
+        blocked = [x for x in results if 'blocking connection' in x]
+        self.assertEqual(len(blocked), 1)
+
+    @timeout(5)
+    def test_eval_threads_eof(self):
+        # data read before the client disconnects is still forwarded
+        self.start_filter('/dev/null', eval_threads=1)
+        server = self.start_server()
+        client = self.start_client()
+        server_client = server.accept()[0]
+        self.sockets.append(server_client)
+
+        data = self.random_string(30)
+        self.send_all(client, data)
+        client.shutdown(socket.SHUT_WR)
+        self.assertEqual(self.recv_size(server_client, len(data)), data)
+        self.stop_filter()
+
+    @timeout(30)
+    def test_many_clients(self):
+        # more descriptors than select() can handle (FD_SETSIZE is 1024)
+        self.start_filter('/dev/null')
+
+        server = self.start_server()
+        pairs = []
+        for _ in range(600):
+            client = self.start_client()
+            server_client = server.accept()[0]
+            self.sockets.append(server_client)
+            pairs.append((client, server_client))
+
+        for client, server_client in pairs:
+            data = self.random_string(30)
+            self.send_all(client, data)
+            self.assertEqual(self.recv_size(server_client, len(data)), data)
+
+            data = self.random_string(30)
+            self.send_all(server_client, data)
+            self.assertEqual(self.recv_size(client, len(data)), data)
+
+        results = self.stop_filter()
+        self.assertEqual(len(results), 600)
+
+    @timeout(10)
+    def test_workers(self):
+        self.start_filter('/dev/null', workers=2)
+
+        server = self.start_server()
+        pairs = []
+        for _ in range(20):
+            client = self.start_client()
+            server_client = server.accept()[0]
+            self.sockets.append(server_client)
+            pairs.append((client, server_client))
+
+        for client, server_client in pairs:
+            data = self.random_string(30)
+            self.send_all(client, data)
+            self.assertEqual(self.recv_size(server_client, len(data)), data)
+
+            data = self.random_string(30)
+            self.send_all(server_client, data)
+            self.assertEqual(self.recv_size(client, len(data)), data)
+
+        results = self.stop_filter()
+        proxied = [x for x in results if 'proxying connection' in x]
+        self.assertEqual(len(proxied), 20)
+
+    @timeout(10)
+    def test_workers_max_connections(self):
+        self.start_filter('/dev/null', workers=2, max_connections=3)
+
+        server = self.start_server()
+        for _ in range(3):
+            client = self.start_client()
+            server_client = server.accept()[0]
+            self.sockets.append(server_client)
+
+            data = self.random_string(30)
+            self.send_all(client, data)
+            self.assertEqual(self.recv_size(server_client, len(data)), data)
+
+        # every worker stops listening once the connections seen by all of
+        # the workers reach the limit
+        time.sleep(2)
+        with self.assertRaises(socket.error):
+            self.start_client()
+
+        results = self.stop_filter()
+        proxied = [x for x in results if 'proxying connection' in x]
+        self.assertEqual(len(proxied), 3)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,478 @@
+#!/usr/bin/python
+
+"""
+Copyright (C) 2015 - Brian Caswell <bmc@lungetech.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import random
+import string
+import threading
+import unittest
+import sys
+sys.path = ['.'] + sys.path
+import ids
+
+
+class TestNetworkFilter(unittest.TestCase):
+    RULES = '\n'.join([
+        'alert (name:"client"; side:client; match:"A";)',
+        'alert (name:"any"; match:"B";)',
+        'alert (name:"server"; side:server; match:"C";)',
+        'alert (name:"never"; side:client; side:server; match:"D";)',
+        'alert (name:"client again"; side:client; regex:"E";)',
+    ])
+
+    def test_side_filters(self):
+        network_filter = ids.NetworkFilter(self.RULES)
+        names = dict((side, [x.name for x in filters]) for side, filters in
+                     network_filter.side_filters.items())
+        self.assertEqual(names[network_filter.CLIENT],
+                         ['client', 'any', 'client again'])
+        self.assertEqual(names[network_filter.SERVER], ['any', 'server'])
+
+    def test_side_matches(self):
+        network_filter = ids.NetworkFilter(self.RULES)
+        self.assertEqual(network_filter(0, network_filter.CLIENT, 'ABCDE'),
+                         ('ABCDE', ['client', 'any']))
+        self.assertEqual(network_filter(0, network_filter.SERVER, 'ABCDE'),
+                         ('ABCDE', ['any', 'server']))
+        self.assertEqual(network_filter(1, network_filter.CLIENT, 'E'),
+                         ('E', ['client again']))
+        self.assertEqual(network_filter(1, network_filter.SERVER, 'E'),
+                         ('E', []))
+
+    def test_state_bitmask(self):
+        rules = '\n'.join([
+            'alert (name:"one"; match:"AB"; state:set,a; state:set,b;)',
+            'alert (name:"two"; match:"CD"; state:is,a; state:unset,b;)',
+            'alert (name:"three"; match:"EF"; state:is,a; state:not,b;)',
+        ])
+        network_filter = ids.NetworkFilter(rules)
+        self.assertEqual(network_filter.state, {'a': 1, 'b': 2})
+
+        self.assertEqual(network_filter(0, network_filter.CLIENT, 'ABEF'),
+                         ('ABEF', ['one']))
+        self.assertEqual(network_filter.sessions[0].state, 3)
+        self.assertEqual(network_filter(0, network_filter.SERVER, 'CDEF'),
+                         ('CDEF', ['two', 'three']))
+        self.assertEqual(network_filter.sessions[0].state, 1)
+
+    def test_regex_offset(self):
+        rules = '\n'.join([
+            'alert (name:"anchored"; match:"X"; regex:"^B+";)',
+            'alert (name:"boundary"; match:"Y"; regex:"\\bC";)',
+        ])
+        network_filter = ids.NetworkFilter(rules)
+        regexes = [x.options[1] for x in network_filter.filters]
+        self.assertEqual([x.positional for x in regexes], [True, False])
+        self.assertEqual(regexes[0].pattern, 'B+')
+
+        self.assertEqual(network_filter(0, network_filter.CLIENT, 'XBBYC'),
+                         ('XBBYC', ['anchored', 'boundary']))
+        window = network_filter.sessions[0].windows[network_filter.CLIENT]
+        self.assertEqual(str(window), '')
+
+    def test_replace_in_place(self):
+        rules = '\n'.join([
+            'alert (name:"partial"; match:"AB"; replace:"XY"; match:"Z";)',
+            'alert (name:"intact"; match:"ABC";)',
+            'alert (name:"replace"; match:"CD"; replace:"AB";)',
+            'block (name:"block"; match:"AB"; replace:"QQ"; match:"E";)',
+        ])
+        network_filter = ids.NetworkFilter(rules)
+
+        # a rule that does not match leaves its replacements undone
+        self.assertEqual(network_filter(0, network_filter.CLIENT, 'ABC'),
+                         ('ABC', ['intact']))
+        self.assertEqual(network_filter(0, network_filter.CLIENT, 'xCD'),
+                         ('xAB', ['replace']))
+
+        data = ids.base.FilterData('ABCD')
+        self.assertIs(data.modify(1, 'xy'), data)
+        data.modify(2, 'z')
+        self.assertEqual(str(data), 'AxzD')
+        self.assertEqual(data.patches, [(1, 'BC'), (2, 'y')])
+        data.rollback(1)
+        self.assertEqual(str(data), 'AxyD')
+        data.rollback(0)
+        self.assertEqual(str(data), 'ABCD')
+
+        # blocks report the content before it was replaced
+        with self.assertRaisesRegexp(ids.base.NetworkFilterException,
+                                     "'block': '1'"):
+            network_filter(1, network_filter.CLIENT, '1ABE')
+
+    def test_buffer_input(self):
+        network_filter = ids.NetworkFilter(self.RULES)
+        read_buffer = bytearray('AB--')
+        data = memoryview(read_buffer)[:2]
+        self.assertEqual(network_filter(0, network_filter.CLIENT, data),
+                         ('AB', ['client', 'any']))
+
+        # the inspection buffer does not refer to the caller's buffer
+        read_buffer[:2] = 'EE'
+        self.assertEqual(str(network_filter.sessions[0].windows[0]), '')
+        self.assertEqual(network_filter(0, network_filter.CLIENT,
+                                        bytearray('EC')),
+                         ('EC', ['client again']))
+        self.assertRaises(AssertionError, network_filter, 0,
+                          network_filter.CLIENT, u'A')
+
+    def test_compile(self):
+        rules = 'alert (name:"rule"; match:"AB", 4; replace:"XY"; regex:"C+";)'
+        network_filter = ids.NetworkFilter(rules)
+        _filter = network_filter.filters[0]
+        self.assertIn("'AB'", _filter.source)
+        self.assertNotIn('log(', _filter.source)
+        self.assertEqual(network_filter(0, network_filter.CLIENT, 'xABCCx'),
+                         ('xXYCCx', ['rule']))
+
+        network_filter.debug = True
+        self.assertIn('log(', _filter.source)
+        self.assertEqual(network_filter(1, network_filter.CLIENT, 'xABCCx'),
+                         ('xXYCCx', ['rule']))
+
+        reference = ids.NetworkFilter(rules, reference=True)
+        reference.debug = True
+        self.assertIsNone(reference.filters[0].source)
+        self.assertEqual(reference.filters[0].check,
+                         reference.filters[0].evaluate)
+
+    def test_watermarks(self):
+        rules = '\n'.join([
+            'alert (name:"bounded"; match:"A"; regex:"B{2}C";)',
+            'alert (name:"unbounded"; match:"A"; regex:"B+C";)',
+            'alert (name:"later"; match:"A"; skip:1; match:"D";)',
+        ])
+        counts = {}
+        for reference in [True, False]:
+            network_filter = ids.NetworkFilter(rules, reference=reference)
+            counts[reference] = dict((x.name, 0)
+                                     for x in network_filter.filters)
+            for _filter in network_filter.filters:
+                def check(side, data, name=_filter.name,
+                          evaluate=_filter.check):
+                    counts[reference][name] += 1
+                    return evaluate(side, data)
+                _filter.check = check
+
+            # work per chunk does not grow with the length of the session
+            for _ in range(100):
+                network_filter(0, network_filter.CLIENT, 'xAxxxxxx')
+            self.assertEqual(network_filter(0, network_filter.CLIENT, 'D'),
+                             ('D', ['later']))
+
+        self.assertEqual(counts[True], {'bounded': 102, 'unbounded': 102,
+                                        'later': 102})
+        self.assertEqual(counts[False], {'bounded': 1, 'unbounded': 101,
+                                         'later': 1})
+
+    def test_search_resume(self):
+        data = ids.base.FilterData('xxABxxA')
+        data.searched = {}
+        data.position = 100
+        self.assertEqual(data.search('key', 'ABC'), -1)
+        self.assertEqual(data.searched, {'key': (100, 105)})
+
+        # only the data after the previous search (and enough before it to
+        # find a string across the boundary) is searched again
+        data = ids.base.FilterData('xxABxxABC')
+        data.searched = {'key': (100, 105)}
+        data.position = 100
+        self.assertEqual(data.search('key', 'AB'), 6)
+        data.searched = {'key': (100, 105)}
+        self.assertEqual(data.search('key', 'ABC'), 6)
+
+        # a search from another offset starts over
+        data.offset = 1
+        self.assertEqual(data.search('key', 'AB'), 2)
+
+        # a rule whose later 'match' fails does not search the data before
+        # the new chunk again, until replacements change the buffer
+        rules = '\n'.join([
+            'alert (name:"later"; match:"Y"; match:"X";)',
+            'alert (name:"replace"; match:"R"; replace:"X";)',
+        ])
+        network_filter = ids.NetworkFilter(rules)
+        network_filter(0, network_filter.CLIENT, 'XY')
+        searched = network_filter.sessions[0].searched[network_filter.CLIENT]
+        for count in range(1, 10):
+            self.assertEqual(network_filter(0, network_filter.CLIENT, 'abc'),
+                             ('abc', []))
+            option = network_filter.filters[0].options[1]
+            self.assertEqual(searched[option], (2, 2 + count * 3))
+        self.assertEqual(network_filter(0, network_filter.CLIENT, 'X'),
+                         ('X', ['later']))
+
+        network_filter(1, network_filter.CLIENT, 'XY')
+        network_filter(1, network_filter.CLIENT, 'abc')
+        searched = network_filter.sessions[1].searched[network_filter.CLIENT]
+        self.assertEqual(len(searched), 1)
+        self.assertEqual(network_filter(1, network_filter.CLIENT, 'R'),
+                         ('X', ['replace']))
+        self.assertEqual(searched, {})
+
+    def test_sessions(self):
+        network_filter = ids.NetworkFilter(self.RULES, 8)
+        sessions = network_filter.sessions
+        network_filter.open('explicit')
+        self.assertEqual(sessions.bytes_allocated(), 0)
+        self.assertRaises(AssertionError, network_filter.open, 'explicit')
+
+        network_filter('explicit', network_filter.CLIENT, 'xyz')
+        network_filter('implicit', network_filter.SERVER, 'A')
+        network_filter('implicit', network_filter.SERVER, 'xxxxxxxx')
+        self.assertEqual(len(sessions), 2)
+        self.assertEqual(sessions.bytes_retained(), 11)
+        self.assertEqual(sessions.bytes_allocated(),
+                         2 * ids.base.InspectionWindow.MIN_CAPACITY)
+
+        self.assertTrue(network_filter.close('explicit'))
+        self.assertFalse(network_filter.close('explicit'))
+        del network_filter['implicit']
+        self.assertEqual(len(sessions), 0)
+        self.assertEqual((sessions.opened, sessions.closed), (2, 2))
+        self.assertEqual(sessions.bytes_retained(), 0)
+
+        record = ids.Session()
+        self.assertRaises(AttributeError, setattr, record, 'extra', None)
+
+    def test_sessions_threads(self):
+        # the buffers are counted while other threads open and close
+        # sessions, as the evaluation threads of cb-proxy do
+        network_filter = ids.NetworkFilter(self.RULES, 8)
+        sessions = network_filter.sessions
+        for session in range(100):
+            network_filter(session, network_filter.CLIENT, 'xyz')
+
+        stopping = []
+
+        def churn():
+            session = 100
+            while not len(stopping):
+                network_filter(session, network_filter.CLIENT, 'xyz')
+                network_filter.close(session - 50)
+                session += 1
+
+        thread = threading.Thread(target=churn)
+        thread.start()
+        try:
+            for _ in range(2000):
+                sessions.bytes_retained()
+                sessions.bytes_allocated()
+        finally:
+            stopping.append(True)
+            thread.join()
+
+
+class TestInspectionWindow(unittest.TestCase):
+    def test_window(self):
+        window = ids.base.InspectionWindow(3000)
+        self.assertEqual(len(window.data), 0)
+
+        # storage is allocated when data is added, and grows up to twice
+        # the buffer size
+        window.append('A' * 1000)
+        self.assertEqual(len(window.data), 4096)
+        window.append('B' * 4000)
+        self.assertEqual(len(window.data), 6000)
+        window.trim(3500)
+        self.assertEqual((window.start, window.end), (3500, 5000))
+
+        # appends that do not fit move the content to the front
+        window.append('C' * 3000)
+        self.assertEqual(len(window.data), 6000)
+        self.assertEqual((window.start, window.end), (0, 4500))
+        self.assertEqual(str(window), 'B' * 1500 + 'C' * 3000)
+
+        # content larger than the storage grows it
+        window.append('D' * 3000)
+        self.assertEqual(len(window), 7500)
+        self.assertEqual(str(window)[-3001:], 'C' + 'D' * 3000)
+
+        # large storage is freed once the window is empty
+        window.truncate(4500)
+        window.trim(4500)
+        self.assertEqual((window.start, window.end), (0, 0))
+        self.assertEqual(len(window.data), 0)
+
+        window.append('E' * 10)
+        window.trim(10)
+        self.assertEqual(len(window.data), 4096)
+
+    def test_window_block(self):
+        network_filter = ids.NetworkFilter(
+            'block (name:"block"; match:"AB"; replace:"XY"; match:"C";)')
+        self.assertEqual(network_filter(0, network_filter.CLIENT, 'xA'),
+                         ('xA', []))
+        with self.assertRaises(ids.base.NetworkFilterException):
+            network_filter(0, network_filter.CLIENT, 'BC')
+
+        # blocked data is not retained
+        window = network_filter.sessions[0].windows[network_filter.CLIENT]
+        self.assertEqual(str(window), 'xA')
+
+
+class TestDifferential(unittest.TestCase):
+    """
+    Validate the NetworkFilter evaluation engine against the reference
+    implementation, which evaluates every rule after each match.
+    """
+    # includes multi-byte UTF-8 characters, which re2 matches as one
+    # character
+    ALPHABET = ['A', 'B', 'C', 'X', '\xc3\xa9', '\xe2\x82\xac']
+    REGEXES = ['A+', 'B.', '.{3}', '^A', '(A|B)C', 'X*', '[^A]+', 'A|^B',
+               '.*', 'C$', '\\bB', '(?m)^B']
+    # regexes with a bounded width, which can fail before the end of the data
+    BOUNDED_REGEXES = ['B.', '.{3}X', '[^X]{2}C', '(?i)a.', '\\W{2}']
+
+    def random_string(self, size):
+        return ''.join(random.choice(self.ALPHABET) for _ in range(size))
+
+    @staticmethod
+    def escape(data):
+        return ''.join(char if char in string.letters else
+                       '\\x%02x' % ord(char) for char in data)
+
+    def random_option(self):
+        keyword = random.choice(['match', 'match', 'match', 'skip', 'state',
+                                 'regex', 'side'])
+        if keyword == 'match':
+            string = self.random_string(random.randint(1, 3))
+            option = 'match:"%s"' % self.escape(string)
+            if random.random() < 0.3:
+                option += ', %d' % random.randint(len(string), len(string) + 3)
+            option += ';'
+            if random.random() < 0.25:
+                replace = self.random_string(len(string))[:len(string)]
+                option += ' replace:"%s";' % self.escape(replace)
+            return option
+        if keyword == 'skip':
+            return 'skip:%d;' % random.randint(0, 3)
+        if keyword == 'state':
+            return 'state:%s,%s;' % (random.choice(['set', 'unset', 'is',
+                                                    'not']),
+                                     random.choice(['p', 'q']))
+        if keyword == 'regex':
+            return 'regex:"%s";' % random.choice(self.REGEXES)
+        return 'side:%s;' % random.choice(['client', 'server'])
+
+    def random_rule(self, name):
+        rule_type = random.choice(['alert', 'alert', 'admit', 'block'])
+        options = ' '.join(self.random_option()
+                           for _ in range(random.randint(1, 4)))
+        if random.random() < 0.1:
+            options += ' flush:%s;' % random.choice(['client', 'server'])
+        return '%s (name:"%s"; %s)' % (rule_type, name, options)
+
+    @staticmethod
+    def run_filter(network_filter, chunks):
+        results = []
+        for session, side, data in chunks:
+            try:
+                results.append(network_filter(session, side, data))
+            except ids.base.NetworkFilterException as error:
+                results.append(str(error))
+                del network_filter[session]
+        return results
+
+    def compare(self, rules, chunks, buffer_size):
+        expected = self.run_filter(
+            ids.NetworkFilter(rules, buffer_size, reference=True), chunks)
+        results = self.run_filter(ids.NetworkFilter(rules, buffer_size),
+                                  chunks)
+        self.assertEqual(results, expected,
+                         'rules: %s chunks: %s' % (rules, repr(chunks)))
+
+    def test_regex_utf8(self):
+        # '.' matches a multi-byte character, so the regex can still match
+        # once more data arrives
+        chunks = [(0, 0, 'A' + '\xc3\xa9' * 3), (0, 0, 'X')]
+        rules = 'alert (name:"u"; match:"A"; regex:".{3}X";)'
+        for reference in (True, False):
+            results = self.run_filter(
+                ids.NetworkFilter(rules, reference=reference), chunks)
+            self.assertEqual(results, [('A' + '\xc3\xa9' * 3, []),
+                                       ('X', ['u'])])
+
+    def random_rules(self):
+        return '\n'.join(self.random_rule('rule %d' % i)
+                         for i in range(random.randint(1, 20)))
+
+    def random_chunks(self):
+        chunks = []
+        for _ in range(random.randint(1, 10)):
+            chunks.append((random.randint(0, 1), random.randint(0, 1),
+                           self.random_string(random.randint(1, 12))))
+        return chunks
+
+    def test_differential(self):
+        random.seed(0)
+        for _ in range(300):
+            self.compare(self.random_rules(), self.random_chunks(),
+                         random.choice([None, 8, 20]))
+
+    def test_finished(self):
+        # once a side of a session is finished, no rule matches its data,
+        # and checking does not change the results
+        random.seed(0)
+        count = 0
+        for _ in range(300):
+            rules = self.random_rules()
+            chunks = self.random_chunks()
+            buffer_size = random.choice([None, 8, 20])
+
+            expected = self.run_filter(
+                ids.NetworkFilter(rules, buffer_size, reference=True), chunks)
+            network_filter = ids.NetworkFilter(rules, buffer_size)
+            finished = set()
+            for index, chunk in enumerate(chunks):
+                session, side, data = chunk
+                result = self.run_filter(network_filter, [chunk])[0]
+                self.assertEqual(result, expected[index],
+                                 'rules: %s chunks: %s' % (rules,
+                                                           repr(chunks)))
+                if (session, side) in finished:
+                    self.assertEqual(result, (data, []))
+                if isinstance(result, str):
+                    finished -= set([(session, 0), (session, 1)])
+                elif network_filter.finished(session, side):
+                    finished.add((session, side))
+                    count += 1
+        self.assertGreater(count, 0)
+
+    def test_differential_regex(self):
+        # bounded regexes following a match, over short chunks of multi-byte
+        # characters
+        random.seed(0)
+        for _ in range(300):
+            rules = '\n'.join(
+                'alert (name:"rule %d"; match:"%s"; regex:"%s";)' %
+                (i, self.escape(self.random_string(1)),
+                 random.choice(self.BOUNDED_REGEXES))
+                for i in range(random.randint(1, 5)))
+            chunks = [(0, 0, self.random_string(random.randint(1, 3)))
+                      for _ in range(random.randint(5, 20))]
+            self.compare(rules, chunks, random.choice([None, 8, 20]))
+
+
+if __name__ == '__main__':
+    unittest.main()
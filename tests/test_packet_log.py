@@ -0,0 +1,103 @@
+#!/usr/bin/python
+
+"""
+Copyright (C) 2015 - Brian Caswell <bmc@lungetech.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import sys
+sys.path = ['.'] + sys.path
+from ids import packet_log
+
+
+class TestPacketLog(unittest.TestCase):
+    def test_version_1(self):
+        message = packet_log.pack(1, 2, 3, 1, 'data')
+        self.assertEqual(message, struct.pack('<LLLHB', 1, 2, 3, 4, 1) +
+                         'data')
+        self.assertEqual(packet_log.parse(message),
+                         (packet_log.VERSION_1, 1, 2, 3, 1, 'data'))
+
+        self.assertRaises(AssertionError, packet_log.pack, 1, 2, 3, 0,
+                          'A' * 1025)
+
+    def test_version_2(self):
+        data = 'A' * 0x8000
+        message = packet_log.pack(1, 2, 3, 0, data, packet_log.VERSION_2)
+        self.assertEqual(len(message), packet_log.HEADER_LEN + len(data))
+        self.assertEqual(packet_log.parse(message),
+                         (packet_log.VERSION_2, 1, 2, 3, 0, data))
+
+        largest = 'A' * packet_log.MAX_MESSAGE_SIZE[packet_log.VERSION_2]
+        message = packet_log.pack(1, 2, 3, 0, largest, packet_log.VERSION_2)
+        self.assertLessEqual(len(message), 0xFFFF - 28)
+
+    def test_invalid(self):
+        message = packet_log.pack(1, 2, 3, 1, 'data')
+        self.assertIsNone(packet_log.parse(message[:10]))
+        self.assertIsNone(packet_log.parse(message[:-1]))
+        self.assertIsNone(packet_log.parse(
+            struct.pack('<LLLHB', 1, 2, 3, 4, 0xf1) + 'data'))
+        self.assertIsNone(packet_log.parse(message + 'extra'))
+
+
+    def test_split(self):
+        messages = [packet_log.pack(0, 1, x, 0, 'A' * x) for x in range(5)]
+        stream = ''.join(messages)
+        self.assertEqual(packet_log.split(stream), (messages, ''))
+
+        # incomplete messages are left for the next read
+        self.assertEqual(packet_log.split(stream[:-1]),
+                         (messages[:-1], messages[-1][:-1]))
+        self.assertEqual(packet_log.split(stream[:10]), ([], stream[:10]))
+
+    def test_pcap_record(self):
+        message = packet_log.pack(1, 2, 3, 1, 'data')
+        record = packet_log.pcap_record(message, 10.5)
+        self.assertEqual(record, struct.pack('>IIII', 10, 500000, 33, 33) +
+                         '\x00' * 12 + '\xff\xff' + message)
+
+    def test_pcap_writer(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp_dir, 'log.pcap')
+            writer = packet_log.PcapWriter(filename, buffer_size=100)
+            messages = [packet_log.pack(1, 2, x, 0, 'A' * 50)
+                        for x in range(10)]
+            for message in messages:
+                writer.write(message, 10.5)
+            writer.close()
+            self.assertEqual(writer.records, 10)
+
+            with open(filename) as pcap_fh:
+                self.assertEqual(pcap_fh.read(), packet_log.pcap_header() +
+                                 ''.join(packet_log.pcap_record(x, 10.5)
+                                         for x in messages))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -24,14 +24,18 @@ THE SOFTWARE.
 import unittest
 import struct
 import os
+import re
 import sys
 import socket
+import subprocess
+import time
 
 sys.path = ['.'] + sys.path
 os.environ['PYTHONPATH'] = ':'.join(sys.path)
 
 from timeout import timeout
 import filter_setup
+from ids import packet_log
 
 
 class TestPcap(filter_setup.BaseClass, unittest.TestCase):
@@ -188,5 +192,269 @@ class TestPcap(filter_setup.BaseClass, unittest.TestCase):
         self.assertEqual(len(results), 2)
 
 
+    @timeout(10)
+    def test_flush_on_exit(self):
+        # messages queued when the last connection closes are still sent
+        self.start_filter('/dev/null', max_connections=1,
+                          pcap_host='127.0.0.1', pcap_port=1999)
+        self.setup_packets()
+
+        server = self.start_server()
+        client = self.start_client()
+        server_client = server.accept()[0]
+        self.sockets.append(server_client)
+
+        data = self.random_string(1024 * 20)
+        self.send_all(server_client, data)
+        self.assertEqual(self.recv_size(client, len(data)), data)
+        client.close()
+        self.process.wait()
+
+        received = ''
+        for msg_id in range(20):
+            response = self.get_packet()
+            self.assertEqual(response[:5], (0, 0, msg_id, 1024,
+                                            TestPcap.CLIENT))
+            received += response[5]
+        self.assertEqual(received, data)
+        self.stop_filter()
+
+
+    @timeout(10)
+    def test_version_2(self):
+        self.start_filter('/dev/null', pcap_host='127.0.0.1', pcap_port=1999,
+                          pcap_version=2, pcap_message_size=0x8000)
+        self.setup_packets()
+
+        server = self.start_server()
+        client = self.start_client()
+        server_client = server.accept()[0]
+        self.sockets.append(server_client)
+
+        data = self.random_string(0x1000)
+        self.send_all(client, data)
+        self.assertEqual(self.recv_size(server_client, len(data)), data)
+
+        # the side byte includes the version
+        response = self.get_packet()
+        self.assertEqual(response, (0, 0, 0, len(data),
+                                    0x20 | TestPcap.SERVER, data))
+
+        data = self.random_string(0x10000)
+        self.send_all(server_client, data)
+        self.assertEqual(self.recv_size(client, len(data)), data)
+
+        received = ''
+        while len(received) < len(data):
+            response = self.get_packet()
+            self.assertEqual(response[4], 0x20 | TestPcap.CLIENT)
+            self.assertLessEqual(response[3], 0x8000)
+            received += response[5]
+        self.assertEqual(received, data)
+        self.stop_filter()
+
+
+    def _proxy_traffic(self, count):
+        """ Send 'count' messages of traffic from the server to the client,
+        returning the data sent """
+        server = self.start_server()
+        client = self.start_client()
+        server_client = server.accept()[0]
+        self.sockets.append(server_client)
+
+        sent = ''
+        for _ in range(count):
+            data = self.random_string(100)
+            self.send_all(server_client, data)
+            self.assertEqual(self.recv_size(client, len(data)), data)
+            sent += data
+        return sent
+
+    @timeout(10)
+    def test_tcp_reconnect(self):
+        # the collector is not listening yet, so messages are queued until
+        # the proxy reconnects
+        self.start_filter('/dev/null', pcap_host='127.0.0.1', pcap_port=1999,
+                          pcap_transport='tcp')
+        sent = self._proxy_traffic(10)
+
+        collector = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.setup_socket(collector)
+        collector.bind(('127.0.0.1', 1999))
+        collector.listen(1)
+        self.sockets.append(collector)
+        stream = collector.accept()[0]
+        self.sockets.append(stream)
+
+        size = (TestPcap.HEADER_LEN + 100) * 10
+        data = self.recv_size(stream, size)
+        self.assertEqual(len(data), size)
+
+        received = ''
+        for msg_id in range(10):
+            header = data[:TestPcap.HEADER_LEN]
+            self.assertEqual(struct.unpack('<LLLHB', header),
+                             (0, 0, msg_id, 100, TestPcap.CLIENT))
+            received += data[TestPcap.HEADER_LEN:TestPcap.HEADER_LEN + 100]
+            data = data[TestPcap.HEADER_LEN + 100:]
+        self.assertEqual(received, sent)
+        self.stop_filter()
+
+    @timeout(10)
+    def test_tcp_terminate(self):
+        # messages queued while the collector is down are sent when the
+        # proxy is terminated
+        self.start_filter('/dev/null', pcap_host='127.0.0.1', pcap_port=1999,
+                          pcap_transport='tcp')
+        sent = self._proxy_traffic(1)
+
+        collector = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.setup_socket(collector)
+        collector.bind(('127.0.0.1', 1999))
+        collector.listen(1)
+        self.sockets.append(collector)
+        self.process.terminate()
+        self.assertEqual(self.process.wait(), 0)
+
+        stream = collector.accept()[0]
+        self.sockets.append(stream)
+        data = self.recv_size(stream, TestPcap.HEADER_LEN + 100)
+        self.assertEqual(struct.unpack('<LLLHB', data[:TestPcap.HEADER_LEN]),
+                         (0, 0, 0, 100, TestPcap.CLIENT))
+        self.assertEqual(data[TestPcap.HEADER_LEN:], sent)
+        self.stop_filter()
+
+    @timeout(10)
+    def test_pcap_transport_args(self):
+        # options that would silently disable logging are rejected
+        for args, error in [
+                (['--pcap_transport', 'tcp'],
+                 '--pcap_transport tcp requires --pcap_host'),
+                (['--pcap_path', 'log.sock'],
+                 '--pcap_path requires --pcap_transport unix'),
+                (['--pcap_transport', 'tcp', '--pcap_host', '127.0.0.1',
+                  '--pcap_path', 'log.sock'],
+                 '--pcap_path requires --pcap_transport unix'),
+                (['--pcap_transport', 'unix'],
+                 '--pcap_transport unix requires --pcap_path')]:
+            process = subprocess.Popen(['bin/cb-proxy', '--host', '127.0.0.1',
+                                        '--port', '7777'] + args,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE)
+            stderr = process.communicate()[1]
+            self.assertEqual(process.returncode, 2)
+            self.assertIn(error, stderr)
+
+    @timeout(10)
+    def test_unix_packet_log(self):
+        path = os.path.join(self.tmp_dir, 'log.sock')
+        pcap_file = os.path.join(self.tmp_dir, 'log.pcap')
+        logger = subprocess.Popen(['bin/cb-packet-log', '--transport', 'unix',
+                                   '--path', path, '--pcap_file', pcap_file],
+                                  stdout=subprocess.PIPE)
+        try:
+            time.sleep(1)
+            self.start_filter('/dev/null', pcap_transport='unix',
+                              pcap_path=path)
+            sent = self._proxy_traffic(5)
+            time.sleep(0.5)
+        finally:
+            logger.terminate()
+            output = logger.communicate()[0]
+
+        self.assertEqual(output.count('message_id: '), 5)
+        received = ''.join(record[14 + TestPcap.HEADER_LEN:]
+                           for record in self._read_pcap(pcap_file))
+        self.assertEqual(received, sent)
+        self.stop_filter()
+
+    @timeout(10)
+    def test_packet_log_summary(self):
+        pcap_file = os.path.join(self.tmp_dir, 'log.pcap')
+        logger = subprocess.Popen(['bin/cb-packet-log', '--pcap_file',
+                                   pcap_file, '--summary_interval', '60'],
+                                  stdout=subprocess.PIPE)
+        try:
+            time.sleep(1)
+            self.start_filter('/dev/null', pcap_host='127.0.0.1',
+                              pcap_port=1999)
+            sent = self._proxy_traffic(5)
+            time.sleep(0.5)
+        finally:
+            logger.terminate()
+            output = logger.communicate()[0]
+
+        # the messages are counted, rather than logged
+        self.assertEqual(output.count('message_id: '), 0)
+        self.assertIn('messages: 5 traffic bytes: 500 invalid: 0', output)
+        received = ''.join(record[14 + TestPcap.HEADER_LEN:]
+                           for record in self._read_pcap(pcap_file))
+        self.assertEqual(received, sent)
+        self.stop_filter()
+
+    @timeout(10)
+    def test_packet_log_summary_interval(self):
+        # summaries are logged during a lull in the messages, and invalid
+        # messages are counted rather than logged
+        logger = subprocess.Popen(['bin/cb-packet-log', '--summary_interval',
+                                   '0.5'], stdout=subprocess.PIPE)
+        try:
+            time.sleep(1)
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sockets.append(sock)
+            for message in ['short', packet_log.pack(0, 0, 0, 0, 'abc'),
+                            packet_log.pack(0, 0, 1, 0, 'abc')[:-1]]:
+                sock.sendto(message, ('127.0.0.1', 1999))
+            time.sleep(1.5)
+        finally:
+            logger.terminate()
+            output = logger.communicate()[0]
+
+        self.assertNotIn('ERROR', output)
+        summaries = [[int(count) for count in summary] for summary in
+                     re.findall(r'messages: (\d+) traffic bytes: (\d+) '
+                                r'invalid: (\d+)', output)]
+        self.assertGreaterEqual(len(summaries), 3)
+        self.assertEqual([sum(counts) for counts in zip(*summaries)],
+                         [1, 3, 2])
+        self.assertEqual(summaries[-1], [0, 0, 0])
+
+    @timeout(10)
+    def test_pcap_file(self):
+        pcap_file = os.path.join(self.tmp_dir, 'proxy.pcap')
+        self.start_filter('/dev/null', pcap_file=pcap_file)
+        sent = self._proxy_traffic(5)
+        self.stop_filter()
+
+        records = self._read_pcap(pcap_file)
+        self.assertEqual(len(records), 5)
+        received = ''
+        for msg_id, record in enumerate(records):
+            self.assertEqual(record[:14], '\x00' * 12 + '\xff\xff')
+            header = record[14:14 + TestPcap.HEADER_LEN]
+            self.assertEqual(struct.unpack('<LLLHB', header)[2:],
+                             (msg_id, 100, TestPcap.CLIENT))
+            received += record[14 + TestPcap.HEADER_LEN:]
+        self.assertEqual(received, sent)
+
+    def _read_pcap(self, filename):
+        """ Read the records of a pcap file written by cb-packet-log or
+        cb-proxy """
+        with open(filename) as pcap_fh:
+            pcap = pcap_fh.read()
+
+        # pcap header, and then a record per message
+        self.assertEqual(struct.unpack('>IHHIIII', pcap[:24]),
+                         (0xa1b2c3d4, 2, 4, 0, 0, 0xFFFF, 1))
+        offset = 24
+        records = []
+        while offset < len(pcap):
+            length = struct.unpack('>IIII', pcap[offset:offset + 16])[2]
+            records.append(pcap[offset + 16:offset + 16 + length])
+            offset += 16 + length
+        self.assertEqual(offset, len(pcap))
+        return records
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,138 @@
+#!/usr/bin/python
+
+"""
+Copyright (C) 2015 - Brian Caswell <bmc@lungetech.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import random
+import unittest
+import sys
+sys.path = ['.'] + sys.path
+import ids
+
+
+class TestLiteralSet(unittest.TestCase):
+    @staticmethod
+    def last_seen(literals, data):
+        """ brute force version of LiteralSet.scan """
+        hits = {}
+        for literal_id, literal in enumerate(literals):
+            offset = data.rfind(literal)
+            if offset != -1:
+                hits[literal_id] = offset
+        return hits
+
+    def test_scan(self):
+        literal_set = ids.prefilter.LiteralSet(['he', 'she', 'his', 'hers'])
+        hits = literal_set.scan('ushers')
+        self.assertEqual(hits, {0: 2, 1: 1, 3: 2})
+
+    def test_duplicates(self):
+        literal_set = ids.prefilter.LiteralSet()
+        self.assertEqual(literal_set.add('AB'), 0)
+        self.assertEqual(literal_set.add('B'), 1)
+        self.assertEqual(literal_set.add('AB'), 0)
+        self.assertEqual(len(literal_set), 2)
+        self.assertEqual(literal_set.scan('xxABx'), {0: 2, 1: 3})
+
+    def test_streaming(self):
+        literal_set = ids.prefilter.LiteralSet(['\x00\x0a', 'ABAB'])
+        hits = literal_set.scan('xxAB')
+        self.assertEqual(hits, {})
+        hits = literal_set.scan('xxABAB\x00', 4, hits)
+        self.assertEqual(hits, {1: 2})
+        hits = literal_set.scan('xxABAB\x00\x0a', 7, hits)
+        self.assertEqual(hits, {0: 6, 1: 2})
+
+    def test_window(self):
+        literal_set = ids.prefilter.LiteralSet(['AB', 'BC'])
+        data = bytearray('ABC__ABCAB_')
+
+        # offsets are relative to the start of the buffer, and the data
+        # outside of the buffer is not scanned
+        hits = literal_set.scan(data, 4, None, 4, 9)
+        self.assertEqual(hits, {0: 1, 1: 2})
+        hits = literal_set.scan(data, 9, hits, 4, 10)
+        self.assertEqual(hits, {0: 4, 1: 2})
+
+    def test_bytes(self):
+        # literals that are not ASCII are only searched for with rfind, as
+        # re2 matches strings as UTF-8
+        literal_set = ids.prefilter.LiteralSet(['\xc3', 'AB', 'a.b'])
+        self.assertEqual(literal_set.scan(bytearray('\xc3\xa9ABa.b\xff')),
+                         {0: 0, 1: 2, 2: 4})
+        self.assertEqual(literal_set.scan('axb\xff\xc3\xa9'), {0: 4})
+
+    def test_random(self):
+        for _ in range(500):
+            literals = set()
+            for _ in range(random.randint(1, 8)):
+                size = random.randint(1, 4)
+                literals.add(''.join(random.choice('abc') for _ in range(size)))
+            literal_set = ids.prefilter.LiteralSet(sorted(literals))
+
+            alphabet = random.choice(['abcd', 'abcdefghijklmnopqrstuvwxyz'])
+            data = ''.join(random.choice(alphabet) for _ in range(40))
+            split = random.randint(0, len(data))
+            hits = literal_set.scan(data[:split])
+            hits = literal_set.scan(data, split, hits)
+            self.assertEqual(hits, self.last_seen(literal_set.literals, data))
+
+
+class TestRegexSet(unittest.TestCase):
+    def check(self, patterns, data):
+        """ validate RegexSet.match against matching each regex """
+        regex_set = ids.prefilter.RegexSet(patterns)
+        found, count = regex_set.match(data)
+        self.assertTrue(count > 0)
+        for index in range(count):
+            expected = ids.rule_options.re.match(patterns[index], data)
+            self.assertEqual(index in found, expected is not None,
+                             '%s against %s' % (patterns[index], repr(data)))
+        return found, count
+
+    def test_match(self):
+        patterns = ['A+', '.{3}', '^B', 'AB', '[^A]']
+        self.check(patterns, 'AAB')
+        self.check(patterns, 'BBB')
+        self.check(patterns, 'CD')
+        found, count = self.check(patterns, 'C')
+        self.assertEqual(found, frozenset([4]))
+
+    def test_no_match(self):
+        regex_set = ids.prefilter.RegexSet(['A', 'B'])
+        self.assertEqual(regex_set.match('CAB'), (frozenset(), 2))
+
+    def test_unsupported(self):
+        regex_set = ids.prefilter.RegexSet()
+        self.assertEqual(regex_set.add('A'), 0)
+        self.assertEqual(regex_set.add('(A)\\1'), None)
+        self.assertEqual(regex_set.add('B'), 1)
+        regex_set.compile()
+        self.assertEqual(len(regex_set), 2)
+
+    def test_empty(self):
+        regex_set = ids.prefilter.RegexSet([])
+        self.assertEqual(regex_set.match('A'), (frozenset(), 0))
+
+
+if __name__ == '__main__':
+    unittest.main()